@@ -6,8 +6,11 @@
     :license: BSD, see LICENSE for more details.
 """
 from trytond.pool import Pool
-from index import IndexBacklog, DocumentType
+from index import IndexBacklog, IndexFingerprint, DocumentType, \
+    DocumentTypeDependency
 from configuration import Configuration
+from metrics import IndexBatch, IndexBatchModel, IndexStatistics, \
+    IndexBacklogStatus
 
 
 def register():
@@ -15,6 +18,12 @@ def register():
     Pool.register(
         Configuration,
         IndexBacklog,
+        IndexFingerprint,
         DocumentType,
+        DocumentTypeDependency,
+        IndexBatch,
+        IndexBatchModel,
+        IndexStatistics,
+        IndexBacklogStatus,
         module="elastic_search", type_="model"
     )
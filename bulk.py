@@ -0,0 +1,400 @@
+# -*- coding: utf-8 -*-
+"""
+    bulk
+
+    Helpers to send documents to elastic search using the bulk API.
+
+    :copyright: © 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import importlib
+import logging
+import threading
+import time
+from datetime import date
+from decimal import Decimal
+from Queue import Empty, Queue
+
+from pyes.exceptions import ElasticSearchException, NoServerAvailable
+from trytond.config import config
+
+__all__ = ['BulkRequest', 'encode', 'encode_default']
+
+#: Status returned by elastic search when it can't keep up with the requests
+TOO_MANY_REQUESTS = 429
+
+# The dumps function of the JSON module used to encode, see `get_dumps`
+_dumps = None
+
+
+def encode_default(value):
+    """
+    Convert the values JSON does not support, so that `elastic_search_json`
+    can return the values of Tryton fields as they are.
+    """
+    if isinstance(value, date):
+        # Dates and datetimes
+        return value.isoformat()
+    elif isinstance(value, Decimal):
+        return float(value)
+    elif isinstance(value, (set, frozenset)):
+        return sorted(value)
+    raise TypeError('%r is not JSON serializable' % (value,))
+
+
+def get_dumps():
+    """
+    Return the function encoding the documents with the JSON module set
+    by the `json_module` option of the `elastic_search` section of the
+    configuration (see `_adapt_dumps`). By default it is simplejson, which
+    encodes much faster with sorted keys, if it is installed and the json
+    module of the standard library otherwise.
+    """
+    global _dumps
+    if _dumps is None:
+        name = config.get('elastic_search', 'json_module')
+        if name:
+            module = importlib.import_module(name)
+        else:
+            try:
+                import simplejson as module
+            except ImportError:
+                import json as module
+        _dumps = _adapt_dumps(module.dumps, name or module.__name__)
+    return _dumps
+
+
+def _convert(value):
+    """
+    Return the value with the values JSON does not support converted (see
+    `encode_default`), for the modules which do not take a default function
+    """
+    if isinstance(value, dict):
+        return dict((k, _convert(v)) for k, v in value.iteritems())
+    elif isinstance(value, (list, tuple)):
+        return [_convert(v) for v in value]
+    elif isinstance(value, (date, Decimal, set, frozenset)):
+        return _convert(encode_default(value))
+    return value
+
+
+def _adapt_dumps(dumps, name):
+    """
+    Return a function encoding data as compact JSON with sorted keys using
+    the dumps function of a JSON module.
+
+    The json module and simplejson take the default function, the sorting
+    of the keys and the separators. ujson only sorts the keys, it is
+    compact already, so the values are converted before. A module which
+    can not sort the keys (like cjson) raises ValueError, as the same
+    document would not always be encoded the same way.
+    """
+    probe = {'b': date(2014, 5, 1), 'a': [Decimal('1.5')]}
+    expected = '{"a":[1.5],"b":"2014-05-01"}'
+
+    def encode_with_default(data):
+        return dumps(
+            data, default=encode_default, sort_keys=True,
+            separators=(',', ':')
+        )
+
+    def encode_converted(data):
+        return dumps(_convert(data), sort_keys=True)
+
+    for function in (encode_with_default, encode_converted):
+        try:
+            if function(probe) == expected:
+                return function
+        except TypeError:
+            # The dumps function does not take the keyword arguments
+            pass
+    raise ValueError(
+        'The dumps function of %s can not encode compact JSON with sorted '
+        'keys, set the json_module option to json, simplejson or ujson'
+        % name
+    )
+
+
+def encode(data):
+    """
+    Encode the given data as compact JSON. The keys are sorted so that the
+    same data is always encoded the same way.
+    """
+    return get_dumps()(data)
+
+
+class BulkRequest(object):
+    """
+    Collects index and delete actions into newline delimited `_bulk`
+    request bodies and sends them when either the number of documents or
+    the size of the body reaches the configured limit.
+
+    Every action is added with a key (usually the id of the backlog entry)
+    and once the actions are sent, the keys are sorted into `succeeded` and
+    `failed` based on the result of each item in the bulk response.
+
+    When `max_in_flight` is more than 0, the requests are sent by as many
+    threads while the caller goes on building the next request. The caller
+    is blocked when that many requests are already waiting to be sent.
+    Requests (or items) rejected by elastic search because it is
+    overloaded are retried after an exponentially growing delay.
+
+    The request is a context manager which stops the threads when leaving
+    the context, even when the actions could not all be added::
+
+        with BulkRequest(conn) as bulk:
+            bulk.index(key, index_name, doc_type, id, data)
+            bulk.flush()
+    """
+
+    def __init__(
+            self, conn, max_docs=500, max_bytes=5242880, max_in_flight=0,
+            max_retries=5, retry_delay=0.5):
+        self.conn = conn
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+
+        #: Keys of the actions that were applied by elastic search
+        self.succeeded = []
+        #: A map of keys of the actions that failed to the error
+        self.failed = {}
+        #: Seconds spent in bulk requests, summed over all the threads
+        self.send_time = 0
+
+        self._actions = []
+        self._size = 0
+        self._queue = None
+        self._workers = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def encode(self, data):
+        """
+        Encode the given data as JSON (see `encode`)
+        """
+        return encode(data)
+
+    def index(self, key, index_name, doc_type, id, data, op_type='index'):
+        """
+        Add an index action for the document
+
+        :param key: Key to report the result of this action against
+        :param index_name: Name of the index
+        :param doc_type: Type of the document
+        :param id: ID of the document
+        :param data: The document to be indexed as a dictionary
+        :param op_type: `index` to replace any existing document or `create`
+                        to leave an existing document untouched
+        """
+        self.index_source(
+            key, index_name, doc_type, id, self.encode(data), op_type
+        )
+
+    def index_source(
+            self, key, index_name, doc_type, id, source, op_type='index'):
+        """
+        Add an index action for an already encoded document
+
+        :param source: The document to be indexed encoded as JSON
+        """
+        header = {
+            op_type: {'_index': index_name, '_type': doc_type, '_id': id}
+        }
+        self.add(key, '%s\n%s' % (self.encode(header), source))
+
+    def delete(self, key, index_name, doc_type, id):
+        """
+        Add a delete action for the document
+
+        :param key: Key to report the result of this action against
+        :param index_name: Name of the index
+        :param doc_type: Type of the document
+        :param id: ID of the document
+        """
+        header = {
+            'delete': {'_index': index_name, '_type': doc_type, '_id': id}
+        }
+        self.add(key, self.encode(header))
+
+    def add(self, key, command):
+        """
+        Add an already encoded bulk command (the action line followed by
+        the source line if any, without the trailing newline).
+        """
+        size = len(command) + 1
+        if self._actions and self._size + size > self.max_bytes:
+            self.submit()
+
+        self._actions.append((key, command))
+        self._size += size
+
+        if len(self._actions) >= self.max_docs:
+            self.submit()
+
+    def submit(self):
+        """
+        Send the pending actions to elastic search, in the background if
+        `max_in_flight` allows it.
+        """
+        if not self._actions:
+            return
+
+        actions, self._actions, self._size = self._actions, [], 0
+        if not self.max_in_flight:
+            self.send(actions)
+            return
+
+        if self._queue is None:
+            self._queue = Queue(self.max_in_flight)
+            for i in range(self.max_in_flight):
+                worker = threading.Thread(target=self._work)
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+        # Blocks while max_in_flight requests are already waiting
+        self._queue.put(actions)
+
+    def flush(self):
+        """
+        Send the pending actions to elastic search and wait until the
+        result of every action is known.
+        """
+        self.submit()
+        self._stop_workers()
+
+    def close(self):
+        """
+        Stop the threads sending the requests, dropping the actions which
+        are not sent yet. The requests being sent are waited for.
+        """
+        self._actions, self._size = [], 0
+        if self._queue is not None:
+            while True:
+                try:
+                    self._queue.get_nowait()
+                except Empty:
+                    break
+        self._stop_workers()
+
+    def _stop_workers(self):
+        "Wait until the threads have sent the queued requests and stop them"
+        if self._queue is not None:
+            for worker in self._workers:
+                self._queue.put(None)
+            for worker in self._workers:
+                worker.join()
+            self._queue, self._workers = None, []
+
+    def _work(self):
+        "Send the requests put in the queue until told to stop"
+        while True:
+            actions = self._queue.get()
+            if actions is None:
+                return
+            try:
+                self.send(actions)
+            except Exception as exc:
+                logging.getLogger('trytond.modules.elasticsearch').exception(
+                    'Bulk request failed'
+                )
+                self._record(failed=[(key, unicode(exc)) for key, _ in actions])
+
+    def send(self, actions):
+        """
+        Send the given actions in a bulk request and record the result of
+        each action. Actions rejected because elastic search is overloaded
+        are retried.
+
+        :param actions: List of (key, command) tuples
+        """
+        start = time.time()
+        try:
+            self._send(actions)
+        finally:
+            with self._lock:
+                self.send_time += time.time() - start
+
+    def _send(self, actions):
+        "Send the actions, retrying the rejected ones, see `send`"
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                time.sleep(self.retry_delay * 2 ** (attempt - 1))
+            last_attempt = attempt == self.max_retries
+
+            # The body is the newline delimited commands, which are
+            # already encoded
+            body = ''.join(['%s\n' % command for key, command in actions])
+            try:
+                result = self.conn._send_request('POST', '/_bulk', body)
+            except (ElasticSearchException, NoServerAvailable) as exc:
+                if getattr(exc, 'status', None) == TOO_MANY_REQUESTS and \
+                        not last_attempt:
+                    continue
+                # The whole request failed, so none of the actions were
+                # applied
+                self._record(failed=[(key, unicode(exc)) for key, _ in actions])
+                return
+
+            actions = self._record_items(actions, result, last_attempt)
+            if not actions:
+                return
+
+    def _record_items(self, actions, result, last_attempt):
+        """
+        Record the result of each action from the bulk response and return
+        the actions to retry.
+        """
+        succeeded, failed, retry = [], [], []
+        for (key, command), item in zip(actions, result['items']):
+            error = self.get_item_error(item)
+            if error is None:
+                succeeded.append(key)
+            elif self.get_item_status(item) == TOO_MANY_REQUESTS and \
+                    not last_attempt:
+                retry.append((key, command))
+            else:
+                failed.append((key, error))
+        self._record(succeeded, failed)
+        return retry
+
+    def _record(self, succeeded=None, failed=None):
+        "Record the result of actions, from any thread"
+        with self._lock:
+            self.succeeded.extend(succeeded or [])
+            self.failed.update(failed or [])
+
+    @staticmethod
+    def get_item_status(item):
+        """
+        Return the HTTP status of an item in the bulk response
+        """
+        (action, result), = item.items()
+        return result.get('status', 200)
+
+    @classmethod
+    def get_item_error(cls, item):
+        """
+        Return the error for an item in the bulk response or None if the
+        action was successful.
+        """
+        (action, result), = item.items()
+        status = cls.get_item_status(item)
+        if action == 'delete' and status == 404:
+            # The document was not in elastic search either.
+            # Never mind!
+            return None
+        if action == 'create' and status == 409:
+            # The document was already indexed, by the incremental updates
+            # while the index was being loaded. It is newer than ours.
+            return None
+        if result.get('error') or status >= 300:
+            return unicode(result.get('error') or status)
+        return None
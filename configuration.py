@@ -7,15 +7,29 @@
 """
 import json
 import logging
+import re
+import threading
+from contextlib import contextmanager
 
+from trytond.cache import Cache
 from trytond.model import ModelView, ModelSQL, ModelSingleton, fields
+from trytond.pool import Pool
 from trytond.transaction import Transaction
 from trytond.config import config
 from pyes import ES
+from pyes.connection_http import update_connection_pool
 from pyes.managers import Indices
 
 __all__ = ['Configuration']
 
+# Connections to elastic search cached per process
+_connections = {}
+_connections_lock = threading.Lock()
+
+# Caches of search results per document type, see `get_search_cache`
+_search_caches = {}
+_search_caches_lock = threading.Lock()
+
 
 class Configuration(ModelSingleton, ModelSQL, ModelView):
     "ElasticSearch Configuration"
@@ -25,29 +39,107 @@ class Configuration(ModelSingleton, ModelSQL, ModelView):
     index_name = fields.Function(fields.Char('Index Name'), 'get_index_name')
     settings = fields.Text('Settings', required=True)
     settings_updated = fields.Boolean('Setting updated', readonly=True)
+    bulk_size = fields.Integer(
+        'Bulk Size', required=True,
+        help='Maximum number of documents sent in a single bulk request'
+    )
+    bulk_max_bytes = fields.Integer(
+        'Bulk Max Bytes', required=True,
+        help='Maximum size in bytes of a single bulk request'
+    )
+    bulk_max_in_flight = fields.Integer(
+        'Bulk Requests In Flight', required=True,
+        help='Number of bulk requests sent in parallel while the next ones '
+        'are prepared. With 0, requests are sent one after the other.'
+    )
+    serialize_processes = fields.Integer(
+        'Serialize Processes', required=True,
+        help='Number of worker processes building the documents in '
+        'parallel, each in its own transaction. With 0, the documents are '
+        'built by the indexing process. Only for the indexer, not for the '
+        'CRON task.'
+    )
 
     @classmethod
     def get_es_connection(cls, **kwargs):
         """
         Return a PYES connection object that can be reused by other models
+
+        The connections are cached per process for the servers, index and
+        keyword arguments, so that the HTTP connections kept alive by pyes
+        are reused across calls instead of being opened again every time.
         """
         # TODO: Raise an exception if the configuration object is not
         # created ?
         # Or create one on the fly when connection is requested ?
-        configuration = cls(1)
-        if not configuration.servers:
+        servers = cls.default_servers()
+        if not servers:
             return
 
-        logger = cls.get_logger()
+        index_name = cls.default_index_name()
+        key = (servers, index_name, repr(sorted(kwargs.items())))
+
+        with _connections_lock:
+            conn = _connections.get(key)
+            if conn is None:
+                if not cls(1).settings_updated:
+                    cls.get_logger().warning(
+                        'Settings are not updated on index'
+                    )
+
+                # Keep enough connections alive per server for the threads
+                # sending bulk requests in parallel
+                update_connection_pool(
+                    maxsize=config.getint('elastic_search', 'pool_size', 10)
+                )
+                conn = _connections[key] = ES(
+                    servers.split(','),
+                    default_indices=[index_name],
+                    **kwargs
+                )
+        return conn
 
-        if not configuration.settings_updated:
-            logger.warning('Settings are not updated on index')
+    @classmethod
+    def clear_es_connections(cls):
+        """
+        Forget the cached connections, so that the next call to
+        `get_es_connection` creates a new one.
+        """
+        with _connections_lock:
+            _connections.clear()
 
-        return ES(
-            configuration.servers.split(','),
-            default_indices=[configuration.index_name],
-            **kwargs
-        )
+    @classmethod
+    def get_search_cache(cls, doc_type):
+        """
+        Return the cache of the results of the searches on the documents of
+        the type (see `ElasticSearchMixin.search_es`).
+
+        There is a Tryton cache per document type, so that indexing the
+        documents of a type (see `clear_search_caches`) only invalidates
+        the results for that type, in every process. The number of results
+        kept per type is the `search_cache_size` option of the
+        `elastic_search` section (1024 by default).
+        """
+        with _search_caches_lock:
+            cache = _search_caches.get(doc_type)
+            if cache is None:
+                cache = _search_caches[doc_type] = Cache(
+                    'elasticsearch_search.%s' % doc_type,
+                    size_limit=config.getint(
+                        'elastic_search', 'search_cache_size', 1024
+                    ),
+                    context=False
+                )
+        return cache
+
+    @classmethod
+    def clear_search_caches(cls, doc_types):
+        """
+        Forget the cached search results of the given document types, once
+        their documents in the index changed
+        """
+        for doc_type in doc_types:
+            cls.get_search_cache(doc_type).clear()
 
     @classmethod
     def get_logger(cls):
@@ -63,6 +155,22 @@ class Configuration(ModelSingleton, ModelSQL, ModelView):
         """
         return False
 
+    @staticmethod
+    def default_bulk_size():
+        return 500
+
+    @staticmethod
+    def default_bulk_max_bytes():
+        return 5 * 1024 * 1024
+
+    @staticmethod
+    def default_bulk_max_in_flight():
+        return 0
+
+    @staticmethod
+    def default_serialize_processes():
+        return 0
+
     @staticmethod
     def default_servers():
         """
@@ -163,9 +271,11 @@ class Configuration(ModelSingleton, ModelSQL, ModelView):
         cls._buttons.update({
             'update_settings': {},
             'refresh_index': {},
+            'rebuild_index': {},
         })
         cls._error_messages.update({
             'invalid_json': 'The JSON data is invalid',
+            'rebuild_in_progress': 'The index "%s" is already being rebuilt',
         })
 
     @classmethod
@@ -218,13 +328,193 @@ class Configuration(ModelSingleton, ModelSQL, ModelView):
             logger.info('Opening Index %s' % config.index_name)
             indices.open_index(config.index_name)
         else:
-            # Create a brand new index
+            # Create a brand new index behind an alias, so that it can be
+            # rebuilt later without any downtime
+            index_name = cls.get_index_version_name(config.index_name, 1)
             logger.info(
-                'Creating new index %s with settings' % config.index_name
+                'Creating new index %s with settings' % index_name
+            )
+            indices.create_index(index_name, config.settings)
+            indices.change_aliases([
+                ('add', index_name, config.index_name, {}),
+            ])
+            # None of the documents are in the new index
+            Pool().get('elasticsearch.index_fingerprint').clear_committed()
+
+        cls.write(records, {'settings_updated': True})
+
+    @classmethod
+    @ModelView.button
+    def rebuild_index(cls, records):
+        """
+        Build a new version of the index from scratch and switch to it once
+        it is complete, without interrupting the searches.
+
+        The index name is an alias to the index `<index name>_v<N>`. A new
+        version of the index is created with the current settings and the
+        mapping of every document type, and all the records are sent to it.
+        In the meantime, the `<index name>_building` alias points to the new
+        index so that `IndexBacklog.update_index` sends the changes to both
+        indices. The records are sent with the `create` operation so that
+        they do not overwrite these more recent changes, and the documents
+        of the records deleted in the meantime are deleted again once they
+        are sent (see `DocumentType.export_records`). Once all the
+        records are in, the alias is moved to the new index in a single
+        atomic operation and the previous version is deleted.
+
+        An index which is not behind an alias yet (created before the index
+        was versioned) has to be deleted before the alias can take its name,
+        so searches fail for a moment while switching to the first version.
+        """
+        DocumentType = Pool().get('elasticsearch.document.type')
+        IndexFingerprint = Pool().get('elasticsearch.index_fingerprint')
+        config, = records
+
+        conn = config.get_es_connection()
+        if conn is None:
+            return
+
+        indices = conn.indices
+        logger = cls.get_logger()
+        alias = config.index_name
+        building_alias = cls.get_building_alias()
+
+        # Map of the existing indices to their aliases
+        aliases = dict(
+            (index, value.get('aliases', {}))
+            for index, value in indices.aliases('_all').iteritems()
+        )
+        if any(building_alias in a for a in aliases.itervalues()):
+            cls.raise_user_error('rebuild_in_progress', (alias,))
+        current_indices = [i for i, a in aliases.iteritems() if alias in a]
+
+        index_name = cls.get_next_index_version_name(alias, aliases.keys())
+
+        logger.info('Creating index %s' % index_name)
+        indices.create_index(index_name, config.settings)
+
+        # There is a single document per record even if more than one
+        # document type is defined for the model
+        document_types = {}
+        for document_type in DocumentType.search([], order=[('id', 'ASC')]):
+            document_types.setdefault(document_type.model.id, document_type)
+        document_types = sorted(document_types.values(), key=int)
+        for document_type in document_types:
+            indices.put_mapping(
+                config.make_type_name(document_type.model.model),
+                json.loads(document_type.mapping),
+                [index_name],
             )
-            indices.create_index(config.index_name, config.settings)
+        indices.change_aliases([('add', index_name, building_alias, {})])
+
+        # The new index will only have the documents of the document types.
+        # The changes indexed from now on are sent to both indices, so their
+        # fingerprints are valid again.
+        IndexFingerprint.clear_committed()
 
-        cls.write([records], {'settings_updated': True})
+        try:
+            with cls.bulk_load(index_name):
+                for document_type in document_types:
+                    document_type.export_records(index_name, op_type='create')
+        except Exception:
+            logger.exception('Rebuilding index %s failed' % index_name)
+            indices.change_aliases([
+                ('remove', index_name, building_alias, {}),
+            ])
+            indices.delete_index(index_name)
+            raise
+
+        if alias in aliases:
+            # A concrete index has the name of the alias
+            logger.info('Deleting unversioned index %s' % alias)
+            indices.delete_index(alias)
+
+        logger.info('Switching %s to index %s' % (alias, index_name))
+        indices.change_aliases(
+            [('remove', i, alias, {}) for i in current_indices] + [
+                ('add', index_name, alias, {}),
+                ('remove', index_name, building_alias, {}),
+            ]
+        )
+        for old_index in current_indices:
+            logger.info('Deleting index %s' % old_index)
+            indices.delete_index(old_index)
+        cls.clear_search_caches([
+            cls.make_type_name(dt.model.model) for dt in document_types
+        ])
+
+        cls.write(records, {'settings_updated': True})
+
+    @classmethod
+    @contextmanager
+    def bulk_load(cls, index_name):
+        """
+        A context manager which disables the refresh and the replicas of
+        the index while documents are loaded into it in bulk. Both are
+        restored and the index is refreshed when leaving the context.
+        """
+        indices = cls.get_es_connection().indices
+
+        previous = {'refresh_interval': '1s'}
+        for value in indices.get_settings(index_name).itervalues():
+            settings = value.get('settings', {})
+            for key in ('refresh_interval', 'number_of_replicas'):
+                # The settings may be flat or nested
+                setting = settings.get(
+                    'index.%s' % key, settings.get('index', {}).get(key)
+                )
+                if setting is not None:
+                    previous[key] = setting
+
+        load_settings = {'refresh_interval': '-1'}
+        if 'number_of_replicas' in previous:
+            # The replicas are rebuilt from the primary when restored
+            load_settings['number_of_replicas'] = 0
+        indices.update_settings(index_name, {'index': load_settings})
+        try:
+            yield
+        finally:
+            indices.update_settings(index_name, {'index': previous})
+            indices.refresh(index_name)
+
+    @staticmethod
+    def get_index_version_name(index_name, version):
+        """
+        Return the name of the given version of the index
+        """
+        return '%s_v%d' % (index_name, version)
+
+    @classmethod
+    def get_next_index_version_name(cls, index_name, existing_indices):
+        """
+        Return the name of the version of the index following the versions
+        in the existing indices
+        """
+        version = 1
+        for index in existing_indices:
+            match = re.match(r'^%s_v(\d+)$' % re.escape(index_name), index)
+            if match:
+                version = max(version, int(match.group(1)) + 1)
+        return cls.get_index_version_name(index_name, version)
+
+    @classmethod
+    def get_building_alias(cls):
+        """
+        Return the name of the alias pointing to the index being rebuilt
+        """
+        return '%s_building' % cls.default_index_name()
+
+    @classmethod
+    def get_building_index(cls, conn):
+        """
+        Return the alias of the index being rebuilt if there is one,
+        otherwise None
+        """
+        if conn is None:
+            return
+        building_alias = cls.get_building_alias()
+        if conn.indices.exists_index(building_alias):
+            return building_alias
 
     @classmethod
     @ModelView.button
@@ -263,4 +553,5 @@ class Configuration(ModelSingleton, ModelSQL, ModelView):
             if 'settings' in values:
                 values['settings_updated'] = False
 
+        cls.clear_es_connections()
         return super(Configuration, cls).write(records, values)
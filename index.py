@@ -7,17 +7,68 @@
     :copyright: © 2013-2014 by Openlabs Technologies & Consulting (P) Limited
     :license: BSD, see LICENSE for more details.
 """
+import hashlib
 import json
+import logging
+import time
+import traceback
+from collections import defaultdict
+from datetime import datetime, timedelta
+from operator import itemgetter
 
-from pyes.exceptions import NotFoundException
+from sql import Column, Literal, Null, Values
+from sql.aggregate import Min
+from sql.conditionals import Coalesce
+from sql.functions import Now
+from sql.operators import Exists
+
+from trytond import backend
+from trytond.cache import Cache
+from trytond.config import config
 from trytond.model import ModelSQL, ModelView, fields
 from trytond.pool import PoolMeta, Pool
+from trytond.transaction import Transaction
 from trytond.exceptions import UserError
+from trytond.tools import reduce_ids
+
+from .bulk import BulkRequest, encode
+from .metrics import BatchMetrics
+from .mixin import ElasticSearchMixin
+from .serialize import SerializerPool
 
 
-__all__ = ['IndexBacklog', 'DocumentType', ]
+__all__ = [
+    'IndexBacklog', 'IndexFingerprint', 'DocumentType',
+    'DocumentTypeDependency',
+]
 __metaclass__ = PoolMeta
 
+#: Channel notified on PostgreSQL when records are added to the backlog
+NOTIFY_CHANNEL = 'elasticsearch_index_backlog'
+
+
+def _execute_insert(query, params):
+    """
+    Execute the insert and return whether it succeeded. When it violates a
+    unique constraint, only the insert is undone: on PostgreSQL, which
+    would abort the transaction, it is run in a savepoint.
+    """
+    DatabaseIntegrityError = backend.get('DatabaseIntegrityError')
+    cursor = Transaction().cursor
+
+    savepoint = backend.name() == 'postgresql'
+    if savepoint:
+        cursor.execute('SAVEPOINT elasticsearch_insert')
+    try:
+        cursor.execute(query, params)
+    except DatabaseIntegrityError:
+        if savepoint:
+            cursor.execute('ROLLBACK TO SAVEPOINT elasticsearch_insert')
+        return False
+    if savepoint:
+        cursor.execute('RELEASE SAVEPOINT elasticsearch_insert')
+    return True
+
 
 class IndexBacklog(ModelSQL, ModelView):
     """
@@ -26,11 +77,100 @@ class IndexBacklog(ModelSQL, ModelView):
 
     This model stores the documents that are yet to be sent to the
     remote full text search index.
+
+    A record is at most once in the backlog. The unique constraint on the
+    model and the id of the record is the only index besides the primary
+    key, to keep the inserts and deletes cheap. The create date of an entry
+    is when it was queued.
+
+    An entry which could not be indexed is not tried again before its next
+    attempt date, see `_mark_failed`.
     """
     __name__ = "elasticsearch.index_backlog"
 
-    record_model = fields.Char('Record Model', required=True, select=True)
-    record_id = fields.Integer('Record ID', required=True, select=True)
+    record_model = fields.Char('Record Model', required=True)
+    record_id = fields.Integer('Record ID', required=True)
+    attempts = fields.Integer('Attempts', readonly=True)
+    last_error = fields.Text('Last Error', readonly=True)
+    next_attempt = fields.DateTime('Next Attempt', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(IndexBacklog, cls).__setup__()
+        cls._sql_constraints += [
+            ('record_unique', 'UNIQUE(record_model, record_id)',
+                'A record can only be once in the backlog.'),
+        ]
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        duplicate = cls.__table__()
+
+        if TableHandler.table_exist(cursor, cls._table):
+            # Remove the duplicates before adding the unique constraint
+            cursor.execute(*table.delete(
+                where=~table.id.in_(duplicate.select(
+                    Min(duplicate.id),
+                    group_by=[duplicate.record_model, duplicate.record_id]
+                ))
+            ))
+
+        super(IndexBacklog, cls).__register__(module_name)
+
+        # The unique constraint indexes both columns
+        table_h = TableHandler(cursor, cls, module_name)
+        table_h.index_action('record_model', 'remove')
+        table_h.index_action('record_id', 'remove')
+
+        cls._set_storage()
+
+    @classmethod
+    def _set_storage(cls):
+        """
+        Tune the storage of the backlog table on PostgreSQL with the options
+        of the `elastic_search` section of the configuration:
+
+        `backlog_unlogged`
+            Store the table UNLOGGED (PostgreSQL 9.5 and later): changes to
+            the backlog are not written to the WAL, but the backlog is
+            emptied after a crash (reindex all the records then) and is not
+            replicated.
+
+        `backlog_fillfactor`
+            The fillfactor of the table, to leave room in the pages for the
+            updates of the failed entries.
+        """
+        if backend.name() != 'postgresql':
+            return
+        cursor = Transaction().cursor
+
+        unlogged = config.getboolean(
+            'elastic_search', 'backlog_unlogged', False
+        )
+        if cursor.connection.server_version >= 90500:
+            cursor.execute(
+                'SELECT relpersistence FROM pg_class WHERE relname = %s',
+                (cls._table,)
+            )
+            persistence, = cursor.fetchone()
+            if unlogged and persistence != 'u':
+                cursor.execute('ALTER TABLE "%s" SET UNLOGGED' % cls._table)
+            elif not unlogged and persistence == 'u':
+                cursor.execute('ALTER TABLE "%s" SET LOGGED' % cls._table)
+
+        fillfactor = config.getint('elastic_search', 'backlog_fillfactor')
+        if fillfactor:
+            cursor.execute(
+                'ALTER TABLE "%s" SET (fillfactor = %d)'
+                % (cls._table, fillfactor)
+            )
+
+    @staticmethod
+    def default_attempts():
+        return 0
 
     @classmethod
     def create_from_records(cls, records):
@@ -41,17 +181,251 @@ class IndexBacklog(ModelSQL, ModelView):
 
         :param record: List of active records to be indexed
         """
-        vlist = []
+        ids_by_model = defaultdict(list)
         for record in records:
-            if not cls.search([
-                    ('record_model', '=', record.__name__),
-                    ('record_id', '=', record.id),
-            ], limit=1):
-                vlist.append({
-                    'record_model': record.__name__,
-                    'record_id': record.id,
-                })
-        return cls.create(vlist)
+            ids_by_model[record.__name__].append(record.id)
+
+        backlogs = []
+        for model_name, ids in ids_by_model.iteritems():
+            backlogs.extend(cls.create_from_ids(model_name, ids))
+        return backlogs
+
+    @classmethod
+    def create_from_ids(cls, model_name, ids):
+        """
+        Add the records of the given model to the indexing backlog unless
+        they are already in it and return the backlog entries added. The
+        records are checked and inserted with one query per chunk of ids
+        (see `_insert_ids`) instead of one query per record.
+
+        :param model_name: Name of the model of the records
+        :param ids: List of ids of the records to be indexed
+        """
+        ids = cls._insert_ids(model_name, ids)
+        cls._get_transaction_queued().update(
+            (model_name, id) for id in ids
+        )
+        queued = cls._get_queued_ids(model_name, ids)
+        return cls.browse([queued[id] for id in ids if id in queued])
+
+    @classmethod
+    def queue_records(cls, records):
+        """
+        Add the records to the indexing backlog like `create_from_records`,
+        but without returning the backlog entries. This is what the triggers
+        and the `ElasticSearchMixin` use.
+
+        The records added by the current transaction are remembered, so
+        that writing the same records again (as an import does) neither
+        queries nor inserts anything. The other records are added with
+        multi-row inserts.
+
+        :param records: List of active records to be indexed
+        """
+        queued = cls._get_transaction_queued()
+        ids_by_model = defaultdict(set)
+        for record in records:
+            if (record.__name__, record.id) not in queued:
+                ids_by_model[record.__name__].add(record.id)
+
+        for model_name, ids in ids_by_model.iteritems():
+            queued.update(
+                (model_name, id) for id in cls._insert_ids(model_name, ids)
+            )
+
+    @staticmethod
+    def _get_transaction_queued():
+        """
+        Return the set of (model name, record id) known to be in the backlog
+        since they were added by the current transaction.
+
+        The set is kept in the cache of the cursor, which is cleared when
+        the transaction is committed or rolled back, as the cursor may be
+        reused by the next transaction (like the cron does). Only the
+        entries inserted by the transaction are in the set: other
+        transactions cannot remove them before they are committed, and the
+        current one forgets them whenever it deletes backlog entries.
+        """
+        # The cache of the cursor holds mappings, which are emptied on
+        # commit and rollback
+        cache = Transaction().cursor.cache.setdefault(
+            'elasticsearch_queued', {}
+        )
+        return cache.setdefault('queued', set())
+
+    @classmethod
+    def delete(cls, backlogs):
+        cls._get_transaction_queued().clear()
+        super(IndexBacklog, cls).delete(backlogs)
+
+    @classmethod
+    def _get_queued_ids(cls, model_name, ids):
+        """
+        Return a map of the ids of the records of the model which are in
+        the backlog to the id of their backlog entry
+        """
+        cursor = Transaction().cursor
+        backlog = cls.__table__()
+
+        ids = list(set(ids))
+        queued_ids = {}
+        for i in range(0, len(ids), cursor.IN_MAX):
+            in_ids = reduce_ids(backlog.record_id, ids[i:i + cursor.IN_MAX])
+            cursor.execute(*backlog.select(
+                backlog.record_id, backlog.id,
+                where=(backlog.record_model == model_name) & in_ids
+            ))
+            queued_ids.update(cursor.fetchall())
+        return queued_ids
+
+    @classmethod
+    def _get_unqueued_ids(cls, model_name, ids):
+        """
+        Return the sorted ids of the records of the model which are not in
+        the backlog yet
+        """
+        queued_ids = cls._get_queued_ids(model_name, ids)
+        return [id for id in sorted(set(ids)) if id not in queued_ids]
+
+    @classmethod
+    def _insert_ids(cls, model_name, ids):
+        """
+        Add the records of the given model which are not in the backlog yet
+        with multi-row inserts, bypassing the ORM. Meant for large numbers
+        of records. Returns the ids of the records added.
+
+        :param model_name: Name of the model of the records
+        :param ids: List of ids of the records to be indexed
+        """
+        cursor = Transaction().cursor
+        backlog = cls.__table__()
+        queued = cls.__table__()
+
+        columns = [
+            backlog.create_uid, backlog.create_date, backlog.record_model,
+            backlog.record_id, backlog.attempts
+        ]
+        # Keep the number of parameters of a query below the limits
+        rows_max = cursor.IN_MAX // len(columns)
+
+        def insert(record_ids):
+            if backend.name() == 'mysql':
+                # MySQL can not select from a list of values
+                return cls._insert(*backlog.insert(columns, [
+                    [Transaction().user, Now(), model_name, record_id, 0]
+                    for record_id in record_ids
+                ]))
+            # The records queued since they were checked are skipped by the
+            # insert itself, which is atomic on SQLite where the constraint
+            # is not enforced.
+            values = Values([[record_id] for record_id in record_ids])
+            same_record = queued.record_id == values.column1
+            return cls._insert(*backlog.insert(columns, values.select(
+                Literal(Transaction().user), Now(), Literal(model_name),
+                values.column1, Literal(0),
+                where=~Exists(queued.select(
+                    queued.id,
+                    where=(queued.record_model == model_name) & same_record
+                ))
+            )))
+
+        ids = cls._get_unqueued_ids(model_name, ids)
+        inserted = []
+        for i in range(0, len(ids), rows_max):
+            sub_ids = ids[i:i + rows_max]
+            if insert(sub_ids):
+                inserted.extend(sub_ids)
+            else:
+                # Some of the records were queued by a concurrent
+                # transaction, the others are inserted one at a time
+                inserted.extend(id for id in sub_ids if insert([id]))
+        if inserted:
+            cls.notify()
+        return inserted
+
+    @classmethod
+    def _insert_dependents(cls, dependency, ids):
+        """
+        Add the records which depend on the given records of the related
+        model of the dependency and are not in the backlog yet. The records
+        are selected and inserted by the database with one query per chunk
+        of ids, so they are never loaded.
+
+        :param dependency: A document type dependency
+        :param ids: List of ids of records of the related model
+        """
+        cursor = Transaction().cursor
+        backlog = cls.__table__()
+        queued = cls.__table__()
+
+        model_name = dependency.document_type.model.model
+        columns = [
+            backlog.create_uid, backlog.create_date, backlog.record_model,
+            backlog.record_id, backlog.attempts
+        ]
+
+        ids = list(set(ids))
+        for i in range(0, len(ids), cursor.IN_MAX):
+            table, from_, where = dependency.get_dependents_query(
+                ids[i:i + cursor.IN_MAX]
+            )
+            same_record = queued.record_id == table.id
+            where &= ~Exists(queued.select(
+                queued.id,
+                where=(queued.record_model == model_name) & same_record
+            ))
+            if not cls._insert(*backlog.insert(columns, from_.select(
+                    Literal(Transaction().user), Now(), Literal(model_name),
+                    table.id, Literal(0), where=where))):
+                # Some of the records were queued by a concurrent
+                # transaction
+                cursor.execute(*from_.select(table.id, where=where))
+                cls._insert_ids(model_name, [id for id, in cursor.fetchall()])
+
+    @classmethod
+    def _expand_dependencies(cls, items):
+        """
+        Add to the backlog the records whose documents depend on the records
+        of the given backlog entries (see `DocumentTypeDependency`).
+
+        Returns the entries to be indexed, which excludes the entries of
+        related models without a document type of their own.
+        """
+        DocumentType = Pool().get('elasticsearch.document.type')
+        Dependency = Pool().get('elasticsearch.document.type.dependency')
+
+        model_names = set(i['record_model'] for i in items).intersection(
+            Dependency.get_related_models()
+        )
+        if not model_names:
+            return items
+
+        for dependency in Dependency.search([
+                ('model.model', 'in', list(model_names)),
+        ]):
+            cls._insert_dependents(dependency, [
+                i['record_id'] for i in items
+                if i['record_model'] == dependency.model.model
+            ])
+        cls.notify()
+
+        indexed = set(dt.model.model for dt in DocumentType.search([
+            ('model.model', 'in', list(model_names)),
+        ]))
+        return [
+            i for i in items
+            if i['record_model'] not in model_names.difference(indexed)
+        ]
+
+    @staticmethod
+    def notify():
+        """
+        Wake up the indexers listening for changes to the backlog. The
+        notification is delivered by PostgreSQL when the transaction is
+        committed and only once per transaction.
+        """
+        if backend.name() == 'postgresql':
+            Transaction().cursor.execute('NOTIFY "%s"' % NOTIFY_CHANNEL)
 
     @staticmethod
     def _build_default_doc(record):
@@ -63,6 +437,292 @@ class IndexBacklog(ModelSQL, ModelView):
             'rec_name': record.rec_name,
         }
 
+    @classmethod
+    def _get_document(cls, record):
+        """
+        Return the document to be indexed for the record
+        """
+        if hasattr(record, 'elastic_search_json'):
+            # A model with the elastic_search_json method
+            return record.elastic_search_json()
+        # A model without elastic_search_json
+        return cls._build_default_doc(record)
+
+    @staticmethod
+    def _get_records(Model, ids):
+        """
+        Return a map of id to active record for the given ids of the model.
+        The ids of records that do not exist anymore are not in the map.
+
+        The existing ids are searched in as few queries as possible and all
+        the records are browsed together, so that the fields read while
+        building the documents are fetched in batches for the whole group.
+        """
+        cursor = Transaction().cursor
+
+        ids = list(set(ids))
+        existing_ids = []
+        for i in range(0, len(ids), cursor.IN_MAX):
+            existing_ids.extend(map(int, Model.search([
+                ('id', 'in', ids[i:i + cursor.IN_MAX]),
+            ], order=[])))
+        return dict((r.id, r) for r in Model.browse(existing_ids))
+
+    @classmethod
+    def _get_sources(cls, model_name, ids, timings=None, errors=None):
+        """
+        Return a map of id to the document encoded as JSON for the given
+        records of the model. The ids of records that do not exist anymore
+        are not in the map.
+
+        When the configuration has serialize processes, the documents are
+        built in parallel by a pool of worker processes (see
+        `SerializerPool`).
+
+        :param timings: A dictionary filled with the seconds spent building
+                        the document of each record, if given
+        :param errors: A dictionary filled with the traceback of the error
+                       raised while building the document of each record
+                       which failed, if given. Such records are not in the
+                       map. Otherwise the error is raised.
+        """
+        config = Pool().get('elasticsearch.configuration')(1)
+        if config.serialize_processes:
+            return SerializerPool.get(
+                config.serialize_processes
+            ).build_sources(model_name, ids, timings, errors)
+        return cls._build_sources(model_name, ids, timings, errors)
+
+    @classmethod
+    def _build_sources(cls, model_name, ids, timings=None, errors=None):
+        """
+        Build the encoded documents of the records in the current process,
+        see `_get_sources`.
+
+        When the document types of the model have languages, the document
+        built in each language is added under the code of the language. The
+        documents of all the records are built in one language at a time,
+        so that the translations are read for all the records at once.
+        """
+        DocumentType = Pool().get('elasticsearch.document.type')
+        Model = Pool().get(model_name)
+
+        if timings is None:
+            timings = {}
+        # Without a dictionary to save them in, the errors are raised
+        failed = {} if errors is None else errors
+
+        def get_document(record):
+            start = time.time()
+            document = cls._call_for_record(
+                errors, record.id, cls._get_document, record
+            )
+            timings[record.id] = timings.get(record.id, 0) + \
+                time.time() - start
+            return document
+
+        records = cls._get_records(Model, ids)
+        documents = dict(
+            (id, get_document(record)) for id, record in records.iteritems()
+        )
+        for language in DocumentType.get_languages(model_name):
+            with Transaction().set_context(language=language):
+                for record in Model.browse(
+                        [id for id in documents if id not in failed]):
+                    document = get_document(record)
+                    if record.id not in failed:
+                        documents[record.id][language] = document
+
+        sources = {}
+        for id, document in documents.iteritems():
+            if id not in failed:
+                sources[id] = cls._call_for_record(errors, id, encode, document)
+        return dict(
+            (id, source) for id, source in sources.iteritems()
+            if id not in failed
+        )
+
+    @staticmethod
+    def _call_for_record(errors, id, function, *args):
+        """
+        Return the result of calling the function for the record. If it
+        raises and errors is a dictionary, the traceback is saved in it for
+        the id of the record and None is returned.
+        """
+        try:
+            return function(*args)
+        except Exception:
+            if errors is None:
+                raise
+            errors[id] = traceback.format_exc()
+
+    @classmethod
+    def _get_batch(cls, batch_size):
+        """
+        Return the backlog entries to be handled in this batch, oldest first.
+
+        When there are entries of more than one model in the backlog, the
+        batch is shared between the models in proportion to the weight of
+        their document types (models without a document type have a weight
+        of 1). This ensures that a model with a lot of changes cannot keep
+        the entries of other models waiting. Any room left in the batch is
+        filled with the oldest remaining entries.
+
+        The entries are claimed for the current transaction, see
+        `_claim_entries`.
+        """
+        DocumentType = Pool().get('elasticsearch.document.type')
+        cursor = Transaction().cursor
+        backlog = cls.__table__()
+
+        # The models are found one at a time through the unique index on
+        # the model and the record, to not scan the whole backlog
+        model_names = []
+        while True:
+            where = Literal(True)
+            if model_names:
+                where = backlog.record_model > model_names[-1]
+            cursor.execute(*backlog.select(
+                Min(backlog.record_model), where=where
+            ))
+            model_name, = cursor.fetchone()
+            if model_name is None:
+                break
+            model_names.append(model_name)
+
+        items = []
+        if len(model_names) > 1:
+            weights = dict.fromkeys(model_names, 1)
+            for document_type in DocumentType.search([
+                    ('model.model', 'in', model_names),
+            ]):
+                weights[document_type.model.model] = document_type.weight
+            total_weight = sum(weights.values()) or 1
+
+            for model_name in model_names:
+                share = batch_size * weights[model_name] // total_weight
+                if weights[model_name]:
+                    share = max(share, 1)
+                share = min(share, batch_size - len(items))
+                if share > 0:
+                    items.extend(
+                        cls._claim_entries(share, model_name=model_name)
+                    )
+
+        if len(items) < batch_size:
+            items.extend(cls._claim_entries(
+                batch_size - len(items),
+                exclude_ids=[item['id'] for item in items]
+            ))
+        return sorted(items, key=itemgetter('id'))
+
+    @classmethod
+    def _claim_entries(cls, limit, model_name=None, exclude_ids=None):
+        """
+        Return the oldest backlog entries (optionally only of the given
+        model) which are due to be tried and lock them until the end of the
+        transaction.
+
+        On PostgreSQL (9.5 and later) the entries locked by other
+        transactions are skipped. This lets several workers run update_index
+        at the same time, each of them handling a different slice of the
+        backlog. MySQL and older PostgreSQL versions wait for the other
+        transaction instead, while SQLite serializes the writers anyway.
+
+        :param limit: Maximum number of entries to return
+        :param model_name: Only return the entries of this model
+        :param exclude_ids: Ids of backlog entries not to return
+        """
+        cursor = Transaction().cursor
+        backlog = cls.__table__()
+
+        where = (backlog.next_attempt == Null) | (
+            backlog.next_attempt <= datetime.now()
+        )
+        if model_name:
+            where &= backlog.record_model == model_name
+        if exclude_ids:
+            where &= ~reduce_ids(backlog.id, exclude_ids)
+
+        query, params = tuple(backlog.select(
+            backlog.id, backlog.record_model, backlog.record_id,
+            where=where, order_by=[backlog.id.asc], limit=limit
+        ))
+        cursor.execute(query + cls._get_lock_clause(), params)
+        return [{
+            'id': id,
+            'record_model': record_model,
+            'record_id': record_id,
+        } for id, record_model, record_id in cursor.fetchall()]
+
+    @classmethod
+    def _insert(cls, query, params):
+        """
+        Execute an insert into the backlog and return whether it succeeded.
+
+        The records inserted are checked not to be in the backlog, but a
+        concurrent transaction may queue them in the meantime. On PostgreSQL
+        9.5 and later the conflicting rows are skipped (see
+        `_get_conflict_clause`). Otherwise the unique constraint makes the
+        insert fail, which only undoes the insert (see `_execute_insert`).
+        """
+        conflict_clause = cls._get_conflict_clause()
+        if conflict_clause:
+            Transaction().cursor.execute(query + conflict_clause, params)
+            return True
+        return _execute_insert(query, params)
+
+    @staticmethod
+    def _get_conflict_clause():
+        """
+        Return the SQL clause added to the inserts into the backlog to skip
+        the records queued by a concurrent transaction since they were
+        checked, if the database supports it.
+        """
+        if backend.name() == 'postgresql' and \
+                Transaction().cursor.connection.server_version >= 90500:
+            return ' ON CONFLICT DO NOTHING'
+        return ''
+
+    @staticmethod
+    def _get_lock_clause():
+        """
+        Return the SQL clause used to lock the claimed backlog entries
+        """
+        if backend.name() == 'postgresql':
+            if Transaction().cursor.connection.server_version >= 90500:
+                return ' FOR UPDATE SKIP LOCKED'
+            return ' FOR UPDATE'
+        elif backend.name() == 'mysql':
+            return ' FOR UPDATE'
+        return ''
+
+    @classmethod
+    def get_max_latency(cls):
+        """
+        Return the age in seconds of the oldest entry in the backlog, which
+        is the longest a change has been waiting to reach the index.
+        """
+        oldest = cls.search_read(
+            [], order=[('id', 'ASC')], limit=1, fields_names=['create_date']
+        )
+        if not oldest:
+            return 0
+        return (datetime.now() - oldest[0]['create_date']).total_seconds()
+
+    @classmethod
+    def _log_max_latency(cls):
+        """
+        Log the age of the oldest backlog entry. It is only looked up when
+        the DEBUG messages are logged, to keep it off every batch.
+        """
+        logger = Pool().get('elasticsearch.configuration').get_logger()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                'Oldest backlog entry is %d seconds old' %
+                cls.get_max_latency()
+            )
+
     @classmethod
     def update_index(cls, batch_size=100):
         """
@@ -72,51 +732,453 @@ class IndexBacklog(ModelSQL, ModelView):
         To be scalable, this operation limits itself to handling the oldest
         batch of records at a time. The batch_size can be optionally passed on
         to this function call. This should be small enough for subsequent
-        transactions not to be blocked for a long time.
+        transactions not to be blocked for a long time. See `_get_batch` for
+        how the batch is shared between models.
 
         That depends on your specific implementation and index size.
+
+        The documents are sent using the bulk API of elastic search and only
+        the backlog entries which were successfully applied are deleted. The
+        ones which failed, or whose document could not be built, remain in
+        the backlog to be tried again (see `_mark_failed`). Documents
+        identical to the last version sent for the record are not sent again
+        (see `IndexFingerprint`).
+
+        The records depending on the records of the batch are added to the
+        backlog, to be indexed by the next batches (see
+        `DocumentTypeDependency`).
+
+        While the index is being rebuilt (see
+        `Configuration.rebuild_index`), the changes are written to the new
+        index too, so that it is up to date when it replaces the current one.
+
+        The time spent in each stage of the batch and the documents handled
+        are saved (see `IndexBatch`).
+
+        Returns the number of backlog entries done, which were removed from
+        the backlog. It is lower than the batch size when the backlog is
+        drained or when entries failed.
         """
+        IndexFingerprint = Pool().get('elasticsearch.index_fingerprint')
+        IndexBatch = Pool().get('elasticsearch.index_batch')
         config = Pool().get('elasticsearch.configuration')(1)
+        metrics = BatchMetrics()
 
         conn = config.get_es_connection()
+        if conn is None:
+            # No server is configured, the backlog is kept until there is one
+            return 0
+
+        cls._log_max_latency()
+
+        with metrics.stage('load'):
+            batch = cls._get_batch(batch_size)
+            items = cls._expand_dependencies(batch)
+        if not batch:
+            return 0
 
-        for item in cls.search_read(
-                [], order=[('id', 'DESC')], limit=batch_size,
-                fields_names=['record_model', 'record_id', 'id']):
+        index_names = cls._get_index_names(conn)
 
-            Model = Pool().get(item['record_model'])
+        items_by_model = defaultdict(list)
+        for item in items:
+            items_by_model[item['record_model']].append(item)
 
-            try:
-                record, = Model.search([('id', '=', item['record_id'])])
-            except ValueError:
+        unchanged, fingerprints, failed = [], {}, {}
+        with BulkRequest(
+                conn, config.bulk_size, config.bulk_max_bytes,
+                config.bulk_max_in_flight) as bulk:
+            for model_name, model_items in items_by_model.iteritems():
+                model_unchanged, model_fingerprints, model_failed = \
+                    cls._add_to_bulk(
+                        bulk, index_names, model_name, model_items, metrics
+                    )
+                unchanged.extend(model_unchanged)
+                fingerprints.update(model_fingerprints)
+                failed.update(model_failed)
+            bulk.flush()
+        metrics.timings['http'] = bulk.send_time
+        failed.update(bulk.failed)
+
+        if unchanged:
+            config.get_logger().info(
+                '%d documents were unchanged and not sent' % len(unchanged)
+            )
+        # An entry written to two indices is only done if both succeeded.
+        succeeded = set(bulk.succeeded).difference(failed)
+
+        models = dict((item['id'], item['record_model']) for item in items)
+        for id in unchanged:
+            metrics.add(models[id], 'skipped')
+        for id in failed:
+            metrics.add(models[id], 'failed')
+        for id in succeeded:
+            metrics.add(
+                models[id],
+                'deleted' if fingerprints[id][2] is None else 'indexed'
+            )
+
+        with metrics.stage('delete'):
+            if failed:
+                config.get_logger().warning(
+                    '%d backlog entries could not be indexed' % len(failed)
+                )
+                cls._mark_failed(failed)
+
+            # The searches on the types written must not return stale
+            # results
+            config.clear_search_caches(set(
+                config.make_type_name(models[id]) for id in succeeded
+            ))
+            IndexFingerprint.update_fingerprints(
+                [fingerprints[id] for id in succeeded]
+            )
+
+            # Delete the items since they have been sent to the index,
+            # along with the ones only there to reach their dependents
+            dependency_only = set(i['id'] for i in batch).difference(models)
+            done = sorted(succeeded.union(unchanged, dependency_only))
+            cls._delete_processed(done)
+
+        IndexBatch.record(metrics, len(batch))
+        return len(done)
+
+    @staticmethod
+    def _get_index_names(conn):
+        """
+        Return the names of the indices to send the changes to: the index
+        and, while it is rebuilt, the new version of the index.
+        """
+        Configuration = Pool().get('elasticsearch.configuration')
+
+        index_names = [Configuration(1).index_name]
+        building_index = Configuration.get_building_index(conn)
+        if building_index:
+            index_names.append(building_index)
+        return index_names
+
+    @classmethod
+    def _add_to_bulk(cls, bulk, index_names, model_name, items, metrics):
+        """
+        Add the actions for the backlog entries of a model to the bulk
+        request, recording the time spent loading and building the
+        documents in the `BatchMetrics` of the batch.
+
+        Returns the ids of the entries whose document is unchanged and so
+        not sent, a map of the ids of the entries sent to the tuple
+        (model name, record id, fingerprint) to save once they succeed and a
+        map of the ids of the entries whose document could not be built to
+        the error. The fingerprint is None for deleted records.
+        """
+        IndexFingerprint = Pool().get('elasticsearch.index_fingerprint')
+        Configuration = Pool().get('elasticsearch.configuration')
+
+        doc_type = Configuration.make_type_name(model_name)  # Document Type
+        record_ids = [i['record_id'] for i in items]
+        timings, errors = {}, {}
+        with metrics.stage('serialize'):
+            sources = cls._get_sources(
+                model_name, record_ids, timings, errors
+            )
+        metrics.add_json_timings(model_name, timings)
+        with metrics.stage('load'):
+            old_fingerprints = IndexFingerprint.get_fingerprints(
+                model_name, record_ids
+            )
+
+        unchanged, fingerprints, failed = [], {}, {}
+        for item in items:
+            record_id = item['record_id']
+            if record_id in errors:
+                failed[item['id']] = errors[record_id]
+                continue
+            source = sources.get(record_id)
+            if source is None:
                 # Record may have been deleted
-                try:
-                    conn.delete(
-                        config.index_name,                      # Index Name
-                        config.make_type_name(Model.__name__),  # Document Type
-                        item['record_id']
+                for index_name in index_names:
+                    bulk.delete(item['id'], index_name, doc_type, record_id)
+                fingerprints[item['id']] = (model_name, record_id, None)
+                continue
+
+            fingerprint = hashlib.sha1(source).hexdigest()
+            if old_fingerprints.get(record_id) == fingerprint:
+                unchanged.append(item['id'])
+                continue
+
+            for index_name in index_names:
+                bulk.index_source(
+                    item['id'], index_name, doc_type, record_id, source
+                )
+            fingerprints[item['id']] = (model_name, record_id, fingerprint)
+        return unchanged, fingerprints, failed
+
+    @classmethod
+    def _delete_processed(cls, ids):
+        """
+        Delete the backlog entries which have been sent to the index.
+
+        This is done with a plain SQL delete per chunk of ids since there is
+        nothing for the ORM to check or trigger on backlog entries.
+        """
+        cursor = Transaction().cursor
+        backlog = cls.__table__()
+
+        cls._get_transaction_queued().clear()
+        for i in range(0, len(ids), cursor.IN_MAX):
+            cursor.execute(*backlog.delete(
+                where=reduce_ids(backlog.id, ids[i:i + cursor.IN_MAX])
+            ))
+
+    @classmethod
+    def _mark_failed(cls, errors):
+        """
+        Increment the attempts and save the error on the backlog entries
+        which could not be indexed.
+
+        An entry is not tried again before a delay which doubles with each
+        attempt, from the `retry_delay` option of the `elastic_search`
+        section (60 seconds by default) up to `retry_max_delay` (6 hours by
+        default). So an entry which keeps failing does not take a share of
+        every batch. After `max_attempts` attempts (10 by default, 0 to try
+        forever) the entry is dropped from the backlog and logged.
+
+        :param errors: A map of backlog entry id to the error
+        """
+        Configuration = Pool().get('elasticsearch.configuration')
+        cursor = Transaction().cursor
+        backlog = cls.__table__()
+        logger = Configuration.get_logger()
+
+        retry_delay = config.getint('elastic_search', 'retry_delay', 60)
+        retry_max_delay = config.getint(
+            'elastic_search', 'retry_max_delay', 21600
+        )
+        max_attempts = config.getint('elastic_search', 'max_attempts', 10)
+
+        ids = sorted(errors)
+        attempts = {}
+        for i in range(0, len(ids), cursor.IN_MAX):
+            cursor.execute(*backlog.select(
+                backlog.id, backlog.record_model, backlog.record_id,
+                Coalesce(backlog.attempts, 0),
+                where=reduce_ids(backlog.id, ids[i:i + cursor.IN_MAX])
+            ))
+            for id, record_model, record_id, count in cursor.fetchall():
+                if max_attempts and count + 1 >= max_attempts:
+                    logger.warning(
+                        'Dropping %s,%d from the backlog after %d attempts: '
+                        '%s' % (record_model, record_id, count + 1, errors[id])
                     )
-                except NotFoundException:
-                    # This record was not there in elastic search too.
-                    # Never mind!
-                    pass
-            else:
-                if hasattr(record, 'elastic_search_json'):
-                    # A model with the elastic_search_json method
-                    data = record.elastic_search_json()
+                    attempts[id] = None
                 else:
-                    # A model without elastic_search_json
-                    data = cls._build_default_doc(record)
-
-                conn.index(
-                    data,
-                    config.index_name,                          # Index Name
-                    config.make_type_name(record.__name__),     # Document Type
-                    record.id,                                  # Record ID
-                )
-            finally:
-                # Delete the item since it has been sent to the index
-                cls.delete([cls(item['id'])])
+                    attempts[id] = count + 1
+
+        dropped = [id for id, count in attempts.iteritems() if count is None]
+        for i in range(0, len(dropped), cursor.IN_MAX):
+            cursor.execute(*backlog.delete(
+                where=reduce_ids(backlog.id, dropped[i:i + cursor.IN_MAX])
+            ))
+
+        now = datetime.now()
+        ids_by_failure = defaultdict(list)
+        for id, count in attempts.iteritems():
+            if count is not None:
+                ids_by_failure[(count, errors[id])].append(id)
+
+        for (count, error), ids in ids_by_failure.iteritems():
+            delay = min(retry_delay * 2 ** (count - 1), retry_max_delay)
+            for i in range(0, len(ids), cursor.IN_MAX):
+                cursor.execute(*backlog.update(
+                    [backlog.attempts, backlog.last_error,
+                        backlog.next_attempt],
+                    [count, error, now + timedelta(seconds=delay)],
+                    where=reduce_ids(backlog.id, ids[i:i + cursor.IN_MAX])
+                ))
+
+
+class IndexFingerprint(ModelSQL):
+    """
+    Index Fingerprint
+    -----------------
+
+    This model stores a hash of the last document sent to the index for
+    each record, so that documents which did not change are not sent
+    again. It is maintained with plain SQL by the backlog.
+    """
+    __name__ = "elasticsearch.index_fingerprint"
+
+    record_model = fields.Char('Record Model', required=True)
+    record_id = fields.Integer('Record ID', required=True)
+    fingerprint = fields.Char('Fingerprint', required=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(IndexFingerprint, cls).__setup__()
+        cls._sql_constraints += [
+            ('record_unique', 'UNIQUE(record_model, record_id)',
+                'A record can only have one fingerprint.'),
+        ]
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        fingerprint = cls.__table__()
+        duplicate = cls.__table__()
+
+        if TableHandler.table_exist(cursor, cls._table):
+            # Forget the records with more than one fingerprint, which may
+            # be stale, before adding the unique constraint
+            same_model = fingerprint.record_model == duplicate.record_model
+            same_id = fingerprint.record_id == duplicate.record_id
+            same_record = same_model & same_id
+            cursor.execute(*table.delete(
+                where=table.id.in_(fingerprint.join(
+                    duplicate,
+                    condition=same_record & (fingerprint.id != duplicate.id)
+                ).select(fingerprint.id))
+            ))
+
+        super(IndexFingerprint, cls).__register__(module_name)
+
+        # The unique constraint indexes both columns
+        table_h = TableHandler(cursor, cls, module_name)
+        table_h.index_action('record_id', 'remove')
+
+    @classmethod
+    def get_fingerprints(cls, model_name, record_ids):
+        """
+        Return a map of record id to the fingerprint of the last document
+        sent for the given records of the model
+        """
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        record_ids = list(set(record_ids))
+        fingerprints = {}
+        for i in range(0, len(record_ids), cursor.IN_MAX):
+            in_ids = reduce_ids(
+                table.record_id, record_ids[i:i + cursor.IN_MAX]
+            )
+            cursor.execute(*table.select(
+                table.record_id, table.fingerprint,
+                where=(table.record_model == model_name) & in_ids
+            ))
+            fingerprints.update(cursor.fetchall())
+        return fingerprints
+
+    @classmethod
+    def update_fingerprints(cls, fingerprints):
+        """
+        Save the fingerprints of the documents sent to the index
+
+        :param fingerprints: A list of (model name, record id, fingerprint)
+                             tuples. The fingerprint of deleted records is
+                             None.
+        """
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        by_model = defaultdict(dict)
+        for model_name, record_id, fingerprint in fingerprints:
+            by_model[model_name][record_id] = fingerprint
+
+        columns = [
+            table.create_uid, table.create_date, table.record_model,
+            table.record_id, table.fingerprint
+        ]
+        # Keep the number of parameters of a query below the limits
+        rows_max = cursor.IN_MAX // len(columns)
+
+        for model_name, model_fingerprints in by_model.iteritems():
+            cls.clear(model_name, [
+                record_id
+                for record_id, fingerprint in model_fingerprints.iteritems()
+                if fingerprint is None
+            ])
+            rows = [
+                [Transaction().user, Now(), model_name, record_id, fingerprint]
+                for record_id, fingerprint in model_fingerprints.iteritems()
+                if fingerprint is not None
+            ]
+            for i in range(0, len(rows), rows_max):
+                cls._upsert(model_name, table, columns, rows[i:i + rows_max])
+
+    @classmethod
+    def _upsert(cls, model_name, table, columns, rows):
+        """
+        Insert the rows of fingerprints of records of the model into the
+        table, replacing the fingerprints already saved for the records.
+
+        PostgreSQL 9.5 and later do it in one statement. Otherwise the
+        fingerprints are deleted before the insert. If a concurrent
+        transaction saves a fingerprint for one of the records in the
+        meantime, the unique constraint makes the insert fail and the
+        fingerprints of the concurrent transaction are kept instead.
+        """
+        cursor = Transaction().cursor
+
+        query, params = tuple(table.insert(columns, rows))
+        if backend.name() == 'postgresql' and \
+                cursor.connection.server_version >= 90500:
+            cursor.execute(
+                query + ' ON CONFLICT ("record_model", "record_id") '
+                'DO UPDATE SET "fingerprint" = EXCLUDED."fingerprint"',
+                params
+            )
+            return
+
+        cls.clear(model_name, [row[3] for row in rows])
+        _execute_insert(query, params)
+
+    @classmethod
+    def clear(cls, model_name=None, record_ids=None):
+        """
+        Forget the fingerprints, so that the next documents are sent to the
+        index whether they changed or not. This must be done whenever the
+        index may not contain the documents of the fingerprints anymore.
+
+        :param model_name: Only forget the fingerprints of this model
+        :param record_ids: Only forget the fingerprints of these records of
+                           the model
+        """
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        if model_name is None:
+            cursor.execute(*table.delete())
+            return
+        if record_ids is None:
+            cursor.execute(*table.delete(
+                where=table.record_model == model_name
+            ))
+            return
+        record_ids = list(record_ids)
+        for i in range(0, len(record_ids), cursor.IN_MAX):
+            in_ids = reduce_ids(
+                table.record_id, record_ids[i:i + cursor.IN_MAX]
+            )
+            cursor.execute(*table.delete(
+                where=(table.record_model == model_name) & in_ids
+            ))
+
+    @classmethod
+    def clear_committed(cls):
+        """
+        Forget all the fingerprints in a short transaction of its own, which
+        is committed at once. Clearing them in a long transaction, like the
+        rebuild of the index, would lock them and block `update_index`
+        until its end.
+
+        On SQLite the transaction writing locks the whole database anyway,
+        so the fingerprints are cleared in the current transaction.
+        """
+        if backend.name() == 'sqlite':
+            cls.clear()
+            return
+        with Transaction().new_cursor():
+            cls.clear()
+            Transaction().cursor.commit()
 
 
 class DocumentType(ModelSQL, ModelView):
@@ -133,11 +1195,51 @@ class DocumentType(ModelSQL, ModelView):
         'ir.trigger', 'Trigger', required=False, ondelete='RESTRICT'
     )
     mapping = fields.Text('Mapping', required=True)
+    source_fields = fields.Char(
+        'Source Fields',
+        help='Comma separated names of the fields of the model used to '
+        'build the documents. Only the changes to these fields update the '
+        'index (for models using the ElasticSearchMixin). When empty, they '
+        'are found from the mapping if possible.'
+    )
+    reindex_last_id = fields.Integer(
+        'Reindexed Up To ID', readonly=True,
+        help='Checkpoint of a reindex of all the records in progress'
+    )
+    weight = fields.Integer(
+        'Weight', required=True,
+        help='Share of each indexing batch given to the records of this '
+        'model when records of other models are waiting too'
+    )
+    dependencies = fields.One2Many(
+        'elasticsearch.document.type.dependency', 'document_type',
+        'Dependencies'
+    )
+    languages = fields.Char(
+        'Languages',
+        help='Comma separated codes of the languages the documents are '
+        'also built in. The document built in each language is added to '
+        'the document under the code of the language.'
+    )
+
+    _source_fields_cache = Cache(
+        'elasticsearch_document_type.source_fields', context=False
+    )
+    _languages_cache = Cache(
+        'elasticsearch_document_type.languages', context=False
+    )
+    _indexed_models_cache = Cache(
+        'elasticsearch_document_type.indexed_models', context=False
+    )
 
     @staticmethod
     def default_mapping():
         return '{}'
 
+    @staticmethod
+    def default_weight():
+        return 1
+
     @classmethod
     def __setup__(cls):
         super(DocumentType, cls).__setup__()
@@ -146,10 +1248,19 @@ class DocumentType(ModelSQL, ModelView):
         cls._buttons.update({
             'update_mapping': {},
             'reindex_all_records': {},
+            'bulk_export': {},
             'get_default_mapping': {},
         })
         cls._error_messages.update({
             'wrong_mapping': 'Mapping does not seem to be valid JSON',
+            'wrong_source_field': (
+                'Source field "%s" does not exist on model "%s"'
+            ),
+            'wrong_language': 'Language "%s" does not exist',
+            'export_failed': (
+                '%s records of "%s" could not be exported. '
+                'The first error was: %s'
+            ),
         })
 
     @classmethod
@@ -158,10 +1269,14 @@ class DocumentType(ModelSQL, ModelView):
         # So that we don't modify the original data passed
         document_types = [dt.copy() for dt in document_types]
         for document_type in document_types:
-            document_type['trigger'] = cls._trigger_create(
+            trigger = cls._trigger_create(
                 document_type['name'],
                 document_type['model']
-            ).id
+            )
+            document_type['trigger'] = trigger.id if trigger else None
+        cls._source_fields_cache.clear()
+        cls._indexed_models_cache.clear()
+        cls._languages_cache.clear()
         return super(DocumentType, cls).create(document_types)
 
     @classmethod
@@ -172,6 +1287,16 @@ class DocumentType(ModelSQL, ModelView):
         if 'trigger' in values:
             raise UserError("Updating Trigger manually is not allowed!")
 
+        if set(values) & set(['model', 'mapping', 'source_fields']):
+            cls._source_fields_cache.clear()
+            cls._indexed_models_cache.clear()
+        if set(values) & set(['model', 'languages']):
+            cls._languages_cache.clear()
+
+        if 'name' not in values and 'model' not in values:
+            # The trigger is unchanged
+            return super(DocumentType, cls).write(document_types, values)
+
         triggers_to_delete = []
         for document_type in document_types:
             triggers_to_delete.append(document_type.trigger)
@@ -182,10 +1307,10 @@ class DocumentType(ModelSQL, ModelView):
                 values_new.get('name', document_type.name),
                 values_new.get('model', document_type.model.id)
             )
-            values_new['trigger'] = trigger.id
+            values_new['trigger'] = trigger.id if trigger else None
             super(DocumentType, cls).write([document_type], values_new)
 
-        Trigger.delete(triggers_to_delete)
+        Trigger.delete(filter(None, triggers_to_delete))
 
     @classmethod
     def delete(cls, document_types):
@@ -193,13 +1318,19 @@ class DocumentType(ModelSQL, ModelView):
         Trigger = Pool().get('ir.trigger')
 
         triggers_to_delete = [dt.trigger for dt in document_types]
+        cls._source_fields_cache.clear()
+        cls._indexed_models_cache.clear()
+        cls._languages_cache.clear()
         super(DocumentType, cls).delete(document_types)
-        Trigger.delete(triggers_to_delete)
+        Trigger.delete(filter(None, triggers_to_delete))
 
     @classmethod
     def _trigger_create(cls, name, model):
         """Create trigger for model
 
+        No trigger is needed (and None is returned) when the model uses the
+        `ElasticSearchMixin`, which adds the records to the backlog itself.
+
         :param name: Name of the DocumentType used as Trigger name
         :param model: Model id
         """
@@ -207,6 +1338,8 @@ class DocumentType(ModelSQL, ModelView):
         Model = Pool().get('ir.model')
 
         index_model = Model(model)
+        if issubclass(Pool().get(index_model.model), ElasticSearchMixin):
+            return None
         action_model, = Model.search([
             ('model', '=', cls.__name__),
         ])
@@ -225,7 +1358,7 @@ class DocumentType(ModelSQL, ModelView):
     @classmethod
     def _trigger_handler(cls, records, trigger):
         "Handler called by trigger"
-        return IndexBacklog.create_from_records(records)
+        IndexBacklog.queue_records(records)
 
     @classmethod
     def validate(cls, document_types):
@@ -233,6 +1366,8 @@ class DocumentType(ModelSQL, ModelView):
         super(DocumentType, cls).validate(document_types)
         for document_type in document_types:
             document_type.check_mapping()
+            document_type.check_source_fields()
+            document_type.check_languages()
 
     def check_mapping(self):
         """
@@ -244,6 +1379,137 @@ class DocumentType(ModelSQL, ModelView):
         except:
             self.raise_user_error('wrong_mapping')
 
+    def check_source_fields(self):
+        """
+        Check that the source fields exist on the model
+        """
+        Model = Pool().get(self.model.model)
+        for field_name in self.get_source_fields() or []:
+            if field_name not in Model._fields:
+                self.raise_user_error(
+                    'wrong_source_field', (field_name, Model.__name__)
+                )
+
+    def check_languages(self):
+        """
+        Check that the languages exist
+        """
+        Lang = Pool().get('ir.lang')
+
+        codes = self.get_language_codes()
+        existing = set(
+            lang.code for lang in Lang.search([('code', 'in', codes)])
+        )
+        for code in codes:
+            if code not in existing:
+                self.raise_user_error('wrong_language', (code,))
+
+    def get_language_codes(self):
+        """
+        Return the list of the codes of the languages of the document type
+        """
+        return [
+            c.strip() for c in (self.languages or '').split(',') if c.strip()
+        ]
+
+    @classmethod
+    def get_languages(cls, model_name):
+        """
+        Return the sorted codes of the languages the documents of the model
+        are built in, besides the language of the context
+
+        :param model_name: Name of the model of the records
+        """
+        languages = cls._languages_cache.get(model_name)
+        if languages is None:
+            languages = set()
+            for document_type in cls.search([
+                    ('model.model', '=', model_name),
+            ]):
+                languages.update(document_type.get_language_codes())
+            languages = sorted(languages)
+            cls._languages_cache.set(model_name, languages)
+        return languages
+
+    def get_source_fields(self):
+        """
+        Return the set of the names of the fields of the model used to build
+        the documents, or None if any field may be.
+
+        Unless the fields are declared, they are the properties of the
+        mapping (or of the `es_mapping` of the model). This only works when
+        every property is a stored field of the model, since the value of
+        any other property may come from any field.
+        """
+        Model = Pool().get(self.model.model)
+
+        if self.source_fields:
+            return set(
+                f.strip() for f in self.source_fields.split(',') if f.strip()
+            )
+
+        mapping = json.loads(self.mapping)
+        if not mapping and hasattr(Model, 'es_mapping'):
+            mapping = Model.es_mapping()
+        if len(mapping) == 1 and 'properties' not in mapping:
+            # The mapping is nested in the name of the type
+            mapping, = mapping.values()
+        properties = mapping.get('properties')
+        if not properties:
+            return None
+
+        source_fields = set()
+        for field_name in properties:
+            field = Model._fields.get(field_name)
+            if field is None or isinstance(field, fields.Function):
+                return None
+            source_fields.add(field_name)
+        return source_fields
+
+    @classmethod
+    def get_indexed_models(cls):
+        """
+        Return the set of the names of the models with a document type
+        """
+        model_names = cls._indexed_models_cache.get(None)
+        if model_names is None:
+            model_names = sorted(set(dt.model.model for dt in cls.search([])))
+            cls._indexed_models_cache.set(None, model_names)
+        return set(model_names)
+
+    @classmethod
+    def is_indexed_change(cls, model_name, field_names):
+        """
+        Return True if changing the given fields of records of the model
+        changes their documents in the index.
+
+        :param model_name: Name of the model of the records
+        :param field_names: Names of the fields changed
+        """
+        # The source fields of all the document types of the model. The
+        # fields are None if any field may be used.
+        source = cls._source_fields_cache.get(model_name)
+        if source is None:
+            source = {'indexed': False, 'fields': []}
+            for document_type in cls.search([
+                    ('model.model', '=', model_name),
+            ]):
+                source['indexed'] = True
+                source_fields = document_type.get_source_fields()
+                if source_fields is None or source['fields'] is None:
+                    source['fields'] = None
+                else:
+                    source['fields'] = sorted(
+                        source_fields.union(source['fields'])
+                    )
+            cls._source_fields_cache.set(model_name, source)
+
+        if not source['indexed']:
+            return False
+        if source['fields'] is None:
+            return True
+        return not set(source['fields']).isdisjoint(field_names)
+
     @classmethod
     @ModelView.button
     def reindex_all_records(cls, document_types):
@@ -252,23 +1518,163 @@ class DocumentType(ModelSQL, ModelView):
 
         :param document_types: Document Types
         """
+        for document_type in document_types:
+            while document_type.reindex_next_chunk():
+                pass
+
+    def reindex_next_chunk(self, chunk_size=1000):
+        """
+        Add the next chunk of records of the model to the backlog and return
+        the number of records in the chunk, 0 once all the records are in.
+
+        The records are walked in the order of their ids, starting after the
+        last id handled by the previous chunk. This id is saved as a
+        checkpoint, so a reindex committed chunk by chunk (see the
+        `--reindex` option of the indexer) resumes where it stopped.
+
+        :param chunk_size: Number of records in a chunk
+        """
         IndexBacklog = Pool().get('elasticsearch.index_backlog')
+        IndexFingerprint = Pool().get('elasticsearch.index_fingerprint')
+        Model = Pool().get(self.model.model)
 
-        for document_type in document_types:
-            Model = Pool().get(document_type.model.model)
-            records = Model.search([])
+        ids = map(int, Model.search([
+            ('id', '>', self.reindex_last_id or 0),
+        ], order=[('id', 'ASC')], limit=chunk_size))
+
+        # The documents must be sent even if they did not change
+        IndexFingerprint.clear(Model.__name__, ids)
+        IndexBacklog._insert_ids(Model.__name__, ids)
+        self.write([self], {'reindex_last_id': ids[-1] if ids else None})
+        return len(ids)
+
+    @classmethod
+    @ModelView.button
+    def bulk_export(cls, document_types):
+        """
+        Send all the records of the models straight to the index, without
+        going through the backlog. Meant for the initial load of an index or
+        to recover a lost one.
+
+        :param document_types: Document Types
+        """
+        Configuration = Pool().get('elasticsearch.configuration')
+        index_name = Configuration(1).index_name
+
+        with Configuration.bulk_load(index_name):
+            for document_type in document_types:
+                document_type.export_records(index_name)
+
+    def export_records(self, index_name, op_type='index'):
+        """
+        Send all the records of the model to the given index with the bulk
+        API, bypassing the backlog, and return the number of documents sent.
+
+        The records are read in chunks of the bulk size in the order of
+        their ids and the progress is logged after each chunk. The documents
+        are built by the serialize processes if configured (see
+        `IndexBacklog._get_sources`).
+
+        :param index_name: Name of the index to send the documents to
+        :param op_type: `create` to leave documents already in the index
+                        untouched
+        """
+        IndexBacklog = Pool().get('elasticsearch.index_backlog')
+        IndexFingerprint = Pool().get('elasticsearch.index_fingerprint')
+        config = Pool().get('elasticsearch.configuration')(1)
+        Model = Pool().get(self.model.model)
+        logger = config.get_logger()
+
+        doc_type = config.make_type_name(Model.__name__)
+
+        # The fingerprints may not match the documents exported
+        IndexFingerprint.clear(Model.__name__)
+
+        total = Model.search([], count=True)
+        logger.info(
+            'Exporting %d records of %s to %s' % (
+                total, Model.__name__, index_name
+            )
+        )
+        start, count, last_id = time.time(), 0, 0
+        with BulkRequest(
+                config.get_es_connection(), config.bulk_size,
+                config.bulk_max_bytes, config.bulk_max_in_flight) as bulk:
+            exported = []
+            while True:
+                ids = map(int, Model.search([
+                    ('id', '>', last_id),
+                ], order=[('id', 'ASC')], limit=config.bulk_size))
+                if not ids:
+                    break
 
-            # Performance speedups
-            index_backlog_create = IndexBacklog.create
-            model_name = Model.__name__
+                sources = IndexBacklog._get_sources(Model.__name__, ids)
+                for id in ids:
+                    if id in sources:
+                        bulk.index_source(
+                            id, index_name, doc_type, id, sources[id],
+                            op_type=op_type
+                        )
+                        exported.append(id)
+                last_id = ids[-1]
+                count += len(ids)
+                logger.info(
+                    '%d/%d records of %s exported (%.0f docs/sec)' % (
+                        count, total, Model.__name__,
+                        count / max(time.time() - start, 0.001)
+                    )
+                )
+            bulk.flush()
+            sent = len(bulk.succeeded)
 
-            vlist = []
-            for record in records:
-                vlist.append({
-                    'record_model': model_name,
-                    'record_id': record.id,
-                })
-            index_backlog_create(vlist)
+            # The deletion of a record deleted by another transaction during
+            # the export may have been indexed before its document was sent,
+            # which would leave the document in the index. So the documents
+            # of the records which no longer exist are deleted again.
+            for id in self._get_deleted_ids(Model, exported):
+                bulk.delete(('delete', id), index_name, doc_type, id)
+            bulk.flush()
+        config.clear_search_caches([doc_type])
+
+        if bulk.failed:
+            self.raise_user_error('export_failed', (
+                len(bulk.failed), self.name, bulk.failed.values()[0]
+            ))
+        logger.info(
+            'Exported %d records of %s in %.1f seconds' % (
+                count, Model.__name__, time.time() - start
+            )
+        )
+        return sent
+
+    @staticmethod
+    def _get_deleted_ids(Model, ids):
+        """
+        Return the ids of the given records of the model which no longer
+        exist, including the ones deleted by transactions committed after
+        the current one started.
+
+        On SQLite the transaction which wrote locks the whole database, so
+        the current transaction is up to date.
+        """
+        table = Model.__table__()
+
+        def get_existing_ids(cursor):
+            existing_ids = set()
+            for i in range(0, len(ids), cursor.IN_MAX):
+                cursor.execute(*table.select(
+                    table.id,
+                    where=reduce_ids(table.id, ids[i:i + cursor.IN_MAX])
+                ))
+                existing_ids.update(id for id, in cursor.fetchall())
+            return existing_ids
+
+        if backend.name() == 'sqlite':
+            existing_ids = get_existing_ids(Transaction().cursor)
+        else:
+            with Transaction().new_cursor(readonly=True) as transaction:
+                existing_ids = get_existing_ids(transaction.cursor)
+        return [id for id in ids if id not in existing_ids]
 
     @classmethod
     @ModelView.button
@@ -305,3 +1711,122 @@ class DocumentType(ModelSQL, ModelView):
                 json.loads(document_type.mapping),                  # Mapping
                 [config.index_name],                                # Index
             )
+
+
+class DocumentTypeDependency(ModelSQL, ModelView):
+    """
+    Elastic Search Document Type Dependency
+
+    The documents of a model may contain data of related records, like the
+    name of the category of a product. A dependency declares the path from
+    the model to such a related model, so that the changes to the related
+    records reindex the records pointing to them.
+    """
+    __name__ = "elasticsearch.document.type.dependency"
+
+    document_type = fields.Many2One(
+        'elasticsearch.document.type', 'Document Type', required=True,
+        select=True, ondelete='CASCADE'
+    )
+    model = fields.Many2One(
+        'ir.model', 'Related Model', required=True, select=True
+    )
+    path = fields.Char(
+        'Path', required=True,
+        help='Names of the Many2One fields leading from the model of the '
+        'document type to the related model, separated by dots. For example '
+        '"category" or "template.category" for products.'
+    )
+
+    _related_models_cache = Cache(
+        'elasticsearch_document_type_dependency.related_models',
+        context=False
+    )
+
+    @classmethod
+    def __setup__(cls):
+        super(DocumentTypeDependency, cls).__setup__()
+        cls._error_messages.update({
+            'wrong_path': (
+                'Path "%s" does not lead from model "%s" to model "%s" '
+                'through stored Many2One fields'
+            ),
+        })
+
+    @classmethod
+    def create(cls, dependencies):
+        cls._related_models_cache.clear()
+        return super(DocumentTypeDependency, cls).create(dependencies)
+
+    @classmethod
+    def write(cls, dependencies, values, *args):
+        cls._related_models_cache.clear()
+        super(DocumentTypeDependency, cls).write(dependencies, values, *args)
+
+    @classmethod
+    def delete(cls, dependencies):
+        cls._related_models_cache.clear()
+        super(DocumentTypeDependency, cls).delete(dependencies)
+
+    @classmethod
+    def validate(cls, dependencies):
+        "Validate the records"
+        super(DocumentTypeDependency, cls).validate(dependencies)
+        for dependency in dependencies:
+            dependency.check_path()
+
+    def check_path(self):
+        """
+        Check that the path follows stored Many2One fields from the model of
+        the document type up to the related model
+        """
+        Model = Pool().get(self.document_type.model.model)
+        for name in self.path.split('.'):
+            field = Model._fields.get(name)
+            if not isinstance(field, fields.Many2One):
+                break
+            if isinstance(field, fields.Function):
+                break
+            Model = Pool().get(field.model_name)
+        else:
+            if Model.__name__ == self.model.model:
+                return
+        self.raise_user_error('wrong_path', (
+            self.path, self.document_type.model.model, self.model.model
+        ))
+
+    @classmethod
+    def get_related_models(cls):
+        """
+        Return the names of the models which are related models of a
+        dependency
+        """
+        model_names = cls._related_models_cache.get(None)
+        if model_names is None:
+            model_names = sorted(set(
+                d.model.model for d in cls.search([])
+            ))
+            cls._related_models_cache.set(None, model_names)
+        return model_names
+
+    def get_dependents_query(self, ids):
+        """
+        Return the table of the model of the document type, the table joined
+        along the path and the condition matching the records which point to
+        the given records of the related model.
+
+        :param ids: List of ids of records of the related model
+        """
+        Model = Pool().get(self.document_type.model.model)
+
+        table = Model.__table__()
+        from_, target = table, table
+        names = self.path.split('.')
+        for name in names[:-1]:
+            Model = Pool().get(Model._fields[name].model_name)
+            joined = Model.__table__()
+            from_ = from_.join(
+                joined, condition=Column(target, name) == joined.id
+            )
+            target = joined
+        return table, from_, reduce_ids(Column(target, names[-1]), ids)
@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+"""
+    indexer
+
+    A long running process which keeps elastic search up to date by
+    draining the index backlog continuously. It can be used instead of the
+    cron task when changes should reach the index within seconds.
+
+    Usage::
+
+        trytond_elastic_search_indexer -c trytond.conf -d database
+
+    :copyright: © 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import argparse
+import logging
+import os
+import select
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from trytond import backend
+from trytond.cache import Cache
+from trytond.config import config
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+from .index import NOTIFY_CHANNEL
+from .metrics import StatsdClient, prometheus_text
+from .serialize import SerializerPool
+
+__all__ = ['Indexer', 'MetricsHandler', 'main']
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+    Serves the metrics of the indexing (see `prometheus_text`) at
+    `/metrics`, for Prometheus to scrape.
+    """
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        try:
+            with Transaction().start(self.server.database_name, 0):
+                text = prometheus_text()
+        except Exception:
+            logging.getLogger('trytond.modules.elasticsearch').exception(
+                'Metrics could not be read'
+            )
+            self.send_error(500)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(text)))
+        self.end_headers()
+        self.wfile.write(text)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Indexer(object):
+    """
+    Drains the index backlog of a database in a loop.
+
+    The batch size adapts to the backlog: it doubles while the batches are
+    full and take less than half of `target_duration` seconds, and it is
+    halved when a batch takes longer than `target_duration`. When the
+    backlog is empty, the indexer sleeps with an exponential backoff from
+    `min_sleep` to `max_sleep` seconds. On PostgreSQL the indexer listens
+    to the notifications sent when records are added to the backlog and
+    wakes up as soon as one arrives.
+
+    When `metrics_port` is set, the metrics of the indexing are served on
+    this port (see `MetricsHandler`). When statsd is configured, the state
+    of the backlog is sent every `status_interval` seconds.
+    """
+
+    def __init__(
+            self, database_name, min_batch_size=100, max_batch_size=5000,
+            target_duration=10, min_sleep=1, max_sleep=60, listen=True,
+            metrics_port=None, status_interval=60):
+        self.database_name = database_name
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.batch_size = min_batch_size
+        self.target_duration = target_duration
+        self.min_sleep = min_sleep
+        self.max_sleep = max_sleep
+        self.listen = listen
+        self.metrics_port = metrics_port
+        self.status_interval = status_interval
+        self.status_time = 0
+
+        self.logger = logging.getLogger('trytond.modules.elasticsearch')
+        self.listener = None
+        self.user_id = None
+
+    def setup(self):
+        """
+        Initialise the pool of the database, find the user to index as,
+        start the serialize processes, start listening to the backlog
+        notifications and serve the metrics.
+        """
+        Pool(self.database_name).init()
+
+        with Transaction().start(self.database_name, 0):
+            ModelData = Pool().get('ir.model.data')
+            Configuration = Pool().get('elasticsearch.configuration')
+            self.user_id = ModelData.get_id(
+                'elastic_search', 'user_update_index'
+            )
+
+            # The workers are forked before any thread is started
+            processes = Configuration(1).serialize_processes
+            if processes:
+                SerializerPool.get(processes)
+
+        if self.listen and backend.name() == 'postgresql':
+            database = backend.get('Database')(self.database_name).connect()
+            self.listener = database.cursor(autocommit=True)
+            self.listener.execute('LISTEN "%s"' % NOTIFY_CHANNEL)
+
+        if self.metrics_port:
+            self.serve_metrics()
+
+    def serve_metrics(self):
+        "Serve the metrics in a daemon thread"
+        server = HTTPServer(('', self.metrics_port), MetricsHandler)
+        server.database_name = self.database_name
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def update_index(self):
+        """
+        Index one batch of the backlog in its own transaction and return
+        the number of backlog entries done.
+        """
+        with Transaction().start(self.database_name, 0) as transaction:
+            Cache.clean(self.database_name)
+            IndexBacklog = Pool().get('elasticsearch.index_backlog')
+            with Transaction().set_user(self.user_id):
+                count = IndexBacklog.update_index(self.batch_size)
+            transaction.cursor.commit()
+            Cache.resets(self.database_name)
+        return count
+
+    def send_backlog_status(self):
+        """
+        Send the state of the backlog to statsd in its own transaction, if
+        `status_interval` seconds passed since it was last sent
+        """
+        if StatsdClient.get() is None or \
+                time.time() - self.status_time < self.status_interval:
+            return
+        self.status_time = time.time()
+        with Transaction().start(self.database_name, 0):
+            IndexBacklogStatus = Pool().get(
+                'elasticsearch.index_backlog.status'
+            )
+            IndexBacklogStatus.send_statsd_metrics()
+
+    def reindex(self, chunk_size=1000):
+        """
+        Add all the records of every document type to the backlog, one
+        chunk of records per transaction. An interrupted reindex resumes
+        from the last chunk committed.
+        """
+        with Transaction().start(self.database_name, 0):
+            DocumentType = Pool().get('elasticsearch.document.type')
+            document_type_ids = map(int, DocumentType.search([]))
+
+        for document_type_id in document_type_ids:
+            count = chunk_size
+            while count:
+                with Transaction().start(self.database_name, 0) as transaction:
+                    DocumentType = Pool().get('elasticsearch.document.type')
+                    document_type = DocumentType(document_type_id)
+                    with Transaction().set_user(self.user_id):
+                        count = document_type.reindex_next_chunk(chunk_size)
+                    transaction.cursor.commit()
+                    if count:
+                        self.logger.info(
+                            'Added %d records of %s to the backlog up to '
+                            'id %d' % (
+                                count, document_type.model.model,
+                                document_type.reindex_last_id
+                            )
+                        )
+
+    def adapt_batch_size(self, count, duration):
+        """
+        Adapt the batch size to the number of entries handled by the last
+        batch and the time it took.
+        """
+        if duration > self.target_duration:
+            self.batch_size = max(self.batch_size // 2, self.min_batch_size)
+        elif count >= self.batch_size and \
+                duration < self.target_duration / 2.0:
+            self.batch_size = min(self.batch_size * 2, self.max_batch_size)
+
+    def wait(self, timeout):
+        """
+        Wait for the given number of seconds or until records are added to
+        the backlog if notifications are available.
+        """
+        if self.listener is None:
+            time.sleep(timeout)
+            return
+
+        connection = self.listener.connection
+        if not connection.notifies:
+            select.select([connection], [], [], timeout)
+            connection.poll()
+        del connection.notifies[:]
+
+    def run(self, reindex=False):
+        """
+        Index the backlog forever
+
+        :param reindex: Add all the records to the backlog first
+        """
+        self.setup()
+        if reindex:
+            self.reindex()
+
+        sleep = self.min_sleep
+        while True:
+            sleep = self.step(sleep)
+
+    def step(self, sleep):
+        """
+        Index one batch, then wait if the backlog looks drained, and return
+        the time to wait after the next batch if it does not bring more
+        work.
+
+        Only the entries removed from the backlog count as work done: when
+        elastic search is down, the batches fail and the indexer backs off
+        from `min_sleep` to `max_sleep` seconds instead of retrying in a
+        loop. After an error the indexer sleeps the whole delay, without
+        waking up on the notifications of the backlog.
+
+        :param sleep: Seconds to wait if there is nothing more to do
+        """
+        try:
+            self.send_backlog_status()
+        except Exception:
+            self.logger.exception('Sending the backlog status failed')
+
+        batch_size, start = self.batch_size, time.time()
+        try:
+            count = self.update_index()
+        except Exception:
+            self.logger.exception('Indexing of the backlog failed')
+            time.sleep(sleep)
+            return min(sleep * 2, self.max_sleep)
+        self.adapt_batch_size(count, time.time() - start)
+
+        if count >= batch_size:
+            # There is probably more in the backlog
+            return self.min_sleep
+
+        self.wait(sleep)
+        if count:
+            return self.min_sleep
+        return min(sleep * 2, self.max_sleep)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='trytond_elastic_search_indexer')
+    parser.add_argument(
+        "-c", "--config", dest="configfile", metavar='FILE',
+        default=os.environ.get('TRYTOND_CONFIG'), help="specify config file"
+    )
+    parser.add_argument(
+        "-d", "--database", dest="database_name", required=True,
+        metavar='DATABASE', help="specify the database name"
+    )
+    parser.add_argument(
+        "--min-batch-size", dest="min_batch_size", type=int, default=100,
+        help="smallest number of backlog entries indexed at a time"
+    )
+    parser.add_argument(
+        "--max-batch-size", dest="max_batch_size", type=int, default=5000,
+        help="largest number of backlog entries indexed at a time"
+    )
+    parser.add_argument(
+        "--target-duration", dest="target_duration", type=float, default=10,
+        help="number of seconds a batch should take at most"
+    )
+    parser.add_argument(
+        "--max-sleep", dest="max_sleep", type=float, default=60,
+        help="longest time in seconds to wait when the backlog is empty"
+    )
+    parser.add_argument(
+        "--no-listen", dest="listen", action="store_false",
+        help="do not use PostgreSQL notifications to wake up"
+    )
+    parser.add_argument(
+        "--reindex", dest="reindex", action="store_true",
+        help="add all the records of every document type to the backlog "
+        "first, resuming an interrupted reindex"
+    )
+    parser.add_argument(
+        "--metrics-port", dest="metrics_port", type=int, metavar='PORT',
+        help="serve the metrics for Prometheus on this port"
+    )
+    parser.add_argument(
+        "--status-interval", dest="status_interval", type=float, default=60,
+        help="number of seconds between the sendings of the state of the "
+        "backlog to statsd"
+    )
+    options = parser.parse_args()
+
+    config.update_etc(options.configfile)
+    logging.basicConfig(
+        level=logging.INFO,
+        format='[%(asctime)s] %(levelname)s:%(name)s:%(message)s'
+    )
+
+    indexer = Indexer(
+        options.database_name,
+        min_batch_size=options.min_batch_size,
+        max_batch_size=options.max_batch_size,
+        target_duration=options.target_duration,
+        max_sleep=options.max_sleep,
+        listen=options.listen,
+        metrics_port=options.metrics_port,
+        status_interval=options.status_interval,
+    )
+    try:
+        indexer.run(reindex=options.reindex)
+    except KeyboardInterrupt:
+        pass
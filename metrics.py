@@ -0,0 +1,544 @@
+# -*- coding: utf-8 -*-
+"""
+    metrics
+
+    Instrumentation of the indexing pipeline: the time spent in each stage
+    of the batches, the documents handled per model and the state of the
+    backlog.
+
+    :copyright: © 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import logging
+import socket
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from sql import Column, Literal
+from sql.aggregate import Count, Max, Min, Sum
+from sql.conditionals import Case, Coalesce
+
+from trytond.config import config
+from trytond.model import ModelSQL, ModelView, fields
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+__all__ = [
+    'IndexBatch', 'IndexBatchModel', 'IndexStatistics', 'IndexBacklogStatus',
+    'BatchMetrics', 'StatsdClient', 'prometheus_text',
+]
+
+#: The stages of an indexing batch
+STAGES = ('load', 'serialize', 'http', 'delete')
+
+#: What can happen to the document of a backlog entry
+RESULTS = ('indexed', 'deleted', 'skipped', 'failed')
+
+#: The old batches are deleted once every this many batches
+PRUNE_INTERVAL = 1000
+
+# Statsd clients cached per process
+_statsd_clients = {}
+_statsd_clients_lock = threading.Lock()
+
+
+class BatchMetrics(object):
+    """
+    Collects the metrics of an indexing batch while it runs: the seconds
+    spent in each stage and, per model, the number of documents indexed,
+    deleted, skipped (because unchanged) and failed, the seconds spent
+    building the documents and the slowest document to build.
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        #: Seconds spent in each stage
+        self.timings = dict.fromkeys(STAGES, 0)
+        #: Number of documents per model and result
+        self.counts = defaultdict(lambda: dict.fromkeys(RESULTS, 0))
+        #: Seconds spent building the documents per model
+        self.json_times = defaultdict(float)
+        #: The (seconds, record id) of the slowest document per model
+        self.slowest_json = {}
+
+    @property
+    def duration(self):
+        "Seconds since the start of the batch"
+        return time.time() - self.start
+
+    @contextmanager
+    def stage(self, name):
+        "Add the time spent in the block to the given stage"
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.timings[name] += time.time() - start
+
+    def add(self, model_name, result, count=1):
+        "Count documents of the model with the given result"
+        self.counts[model_name][result] += count
+
+    def add_json_timings(self, model_name, timings):
+        """
+        Record the time spent building the documents of records of the model
+
+        :param timings: A map of record id to the seconds spent building
+                        its document
+        """
+        if not timings:
+            return
+        self.json_times[model_name] += sum(timings.itervalues())
+        record_id = max(timings, key=timings.get)
+        if timings[record_id] > self.slowest_json.get(model_name, (0,))[0]:
+            self.slowest_json[model_name] = (timings[record_id], record_id)
+
+    def get_model_names(self):
+        "Return the names of the models of the batch"
+        return sorted(set(self.counts).union(self.json_times))
+
+    def get_statsd_metrics(self, entries):
+        """
+        Return the metrics of the batch as a list of (name, value, type)
+        for statsd
+
+        :param entries: Number of backlog entries in the batch
+        """
+        metrics = [
+            ('batch.entries', entries, 'c'),
+            ('batch.duration', int(self.duration * 1000), 'ms'),
+        ]
+        for stage in STAGES:
+            metrics.append((
+                'batch.%s' % stage, int(self.timings[stage] * 1000), 'ms'
+            ))
+        for model_name in self.get_model_names():
+            key = model_name.replace('.', '_')
+            for result in RESULTS:
+                metrics.append((
+                    '%s.%s' % (key, result),
+                    self.counts[model_name][result], 'c'
+                ))
+            metrics.append((
+                '%s.json' % key, int(self.json_times[model_name] * 1000), 'ms'
+            ))
+        return metrics
+
+
+class IndexBatch(ModelSQL, ModelView):
+    """
+    Index Batch
+    -----------
+
+    One entry per batch of the backlog indexed by `update_index`, with the
+    seconds spent in each stage of the batch and the documents handled per
+    model. The stages are:
+
+    * load: claiming the backlog entries, finding their dependents and
+      reading the fingerprints of the documents
+    * serialize: building and encoding the documents
+    * http: the bulk requests, summed over the requests sent in parallel
+    * delete: saving the results and deleting the backlog entries done
+
+    The batches are only ever inserted, so that workers indexing in
+    parallel do not wait for each other. Batches older than the
+    `metrics_retention` option of the `elastic_search` section (7 days by
+    default) are deleted.
+    """
+    __name__ = 'elasticsearch.index_batch'
+
+    entries = fields.Integer('Backlog Entries', readonly=True)
+    duration = fields.Float('Duration', readonly=True, help='In seconds')
+    load_time = fields.Float('Load Time', readonly=True, help='In seconds')
+    serialize_time = fields.Float(
+        'Serialize Time', readonly=True, help='In seconds'
+    )
+    http_time = fields.Float('HTTP Time', readonly=True, help='In seconds')
+    delete_time = fields.Float(
+        'Delete Time', readonly=True, help='In seconds'
+    )
+    models = fields.One2Many(
+        'elasticsearch.index_batch.model', 'batch', 'Models', readonly=True
+    )
+
+    @classmethod
+    def __setup__(cls):
+        super(IndexBatch, cls).__setup__()
+        cls._order.insert(0, ('id', 'DESC'))
+
+    @classmethod
+    def record(cls, metrics, entries):
+        """
+        Save the metrics of a batch and send them to statsd if configured
+
+        :param metrics: The `BatchMetrics` of the batch
+        :param entries: Number of backlog entries in the batch
+        """
+        lines = []
+        for model_name in metrics.get_model_names():
+            slowest_time, slowest_record = metrics.slowest_json.get(
+                model_name, (0, None)
+            )
+            line = {
+                'record_model': model_name,
+                'json_time': metrics.json_times[model_name],
+                'slowest_json_time': slowest_time,
+                'slowest_json_record': slowest_record,
+            }
+            line.update(metrics.counts[model_name])
+            lines.append(line)
+
+        values = {
+            'entries': entries,
+            'duration': metrics.duration,
+            'models': [('create', lines)],
+        }
+        for stage in STAGES:
+            values['%s_time' % stage] = metrics.timings[stage]
+
+        # The indexing user is not allowed to write the metrics
+        with Transaction().set_user(0):
+            batch, = cls.create([values])
+        if not batch.id % PRUNE_INTERVAL:
+            cls.prune()
+
+        client = StatsdClient.get()
+        if client:
+            client.send(metrics.get_statsd_metrics(entries))
+        return batch
+
+    @classmethod
+    def prune(cls):
+        "Delete the batches older than the retention period"
+        BatchModel = Pool().get('elasticsearch.index_batch.model')
+        cursor = Transaction().cursor
+        batch = cls.__table__()
+        line = BatchModel.__table__()
+
+        cutoff = datetime.now() - timedelta(
+            days=config.getint('elastic_search', 'metrics_retention', 7)
+        )
+        old_batches = batch.select(
+            batch.id, where=batch.create_date < cutoff
+        )
+        cursor.execute(*line.delete(where=line.batch.in_(old_batches)))
+        cursor.execute(*batch.delete(where=batch.create_date < cutoff))
+
+
+class IndexBatchModel(ModelSQL, ModelView):
+    "Documents of a model handled by an indexing batch"
+    __name__ = 'elasticsearch.index_batch.model'
+
+    batch = fields.Many2One(
+        'elasticsearch.index_batch', 'Batch', required=True, select=True,
+        ondelete='CASCADE', readonly=True
+    )
+    record_model = fields.Char('Record Model', readonly=True)
+    indexed = fields.Integer('Indexed', readonly=True)
+    deleted = fields.Integer('Deleted', readonly=True)
+    skipped = fields.Integer(
+        'Skipped', readonly=True,
+        help='Documents not sent because they did not change'
+    )
+    failed = fields.Integer('Failed', readonly=True)
+    json_time = fields.Float(
+        'JSON Time', readonly=True,
+        help='Seconds spent building the documents'
+    )
+    slowest_json_time = fields.Float(
+        'Slowest JSON Time', readonly=True,
+        help='Seconds spent building the slowest document'
+    )
+    slowest_json_record = fields.Integer(
+        'Slowest JSON Record ID', readonly=True
+    )
+
+
+class IndexStatistics(ModelSQL, ModelView):
+    """
+    Index Statistics
+    ----------------
+
+    The documents handled per model by the batches still kept (see
+    `IndexBatch`).
+    """
+    __name__ = 'elasticsearch.index_statistics'
+
+    record_model = fields.Char('Record Model', readonly=True)
+    batches = fields.Integer('Batches', readonly=True)
+    indexed = fields.Integer('Indexed', readonly=True)
+    deleted = fields.Integer('Deleted', readonly=True)
+    skipped = fields.Integer('Skipped', readonly=True)
+    failed = fields.Integer('Failed', readonly=True)
+    json_time = fields.Float(
+        'JSON Time', readonly=True,
+        help='Seconds spent building the documents'
+    )
+    slowest_json_time = fields.Float(
+        'Slowest JSON Time', readonly=True,
+        help='Seconds spent building the slowest document'
+    )
+    slowest_json_record = fields.Function(
+        fields.Integer('Slowest JSON Record ID'), 'get_slowest_json_record'
+    )
+
+    @classmethod
+    def __setup__(cls):
+        super(IndexStatistics, cls).__setup__()
+        cls._order.insert(0, ('record_model', 'ASC'))
+
+    @staticmethod
+    def table_query():
+        BatchModel = Pool().get('elasticsearch.index_batch.model')
+        line = BatchModel.__table__()
+
+        return line.select(
+            Min(line.id).as_('id'),
+            Literal(0).as_('create_uid'),
+            Min(line.create_date).as_('create_date'),
+            Literal(0).as_('write_uid'),
+            Max(line.create_date).as_('write_date'),
+            line.record_model,
+            Count(line.id).as_('batches'),
+            Sum(line.indexed).as_('indexed'),
+            Sum(line.deleted).as_('deleted'),
+            Sum(line.skipped).as_('skipped'),
+            Sum(line.failed).as_('failed'),
+            Sum(line.json_time).as_('json_time'),
+            Max(line.slowest_json_time).as_('slowest_json_time'),
+            group_by=[line.record_model]
+        )
+
+    @classmethod
+    def get_slowest_json_record(cls, statistics, name):
+        BatchModel = Pool().get('elasticsearch.index_batch.model')
+
+        result = {}
+        for statistic in statistics:
+            lines = BatchModel.search([
+                ('record_model', '=', statistic.record_model),
+            ], order=[('slowest_json_time', 'DESC')], limit=1)
+            result[statistic.id] = \
+                lines[0].slowest_json_record if lines else None
+        return result
+
+
+class IndexBacklogStatus(ModelSQL, ModelView):
+    """
+    Index Backlog Status
+    --------------------
+
+    The number of entries waiting in the backlog and the age of the oldest
+    one per model. The id of a status is the id of the oldest entry of the
+    model.
+    """
+    __name__ = 'elasticsearch.index_backlog.status'
+
+    record_model = fields.Char('Record Model', readonly=True)
+    entries = fields.Integer('Entries', readonly=True)
+    failing = fields.Integer(
+        'Failing Entries', readonly=True,
+        help='Entries which could not be indexed at least once'
+    )
+    oldest_date = fields.Function(
+        fields.DateTime('Oldest Entry'), 'get_oldest_date'
+    )
+    age = fields.Function(
+        fields.Float('Age', help='Seconds since the oldest entry was queued'),
+        'get_age'
+    )
+
+    @classmethod
+    def __setup__(cls):
+        super(IndexBacklogStatus, cls).__setup__()
+        cls._order.insert(0, ('record_model', 'ASC'))
+
+    @staticmethod
+    def table_query():
+        IndexBacklog = Pool().get('elasticsearch.index_backlog')
+        backlog = IndexBacklog.__table__()
+
+        return backlog.select(
+            Min(backlog.id).as_('id'),
+            Literal(0).as_('create_uid'),
+            Min(backlog.create_date).as_('create_date'),
+            Literal(0).as_('write_uid'),
+            Max(backlog.create_date).as_('write_date'),
+            backlog.record_model,
+            Count(backlog.id).as_('entries'),
+            Sum(Case(
+                (Coalesce(backlog.attempts, 0) > 0, 1), else_=0
+            )).as_('failing'),
+            group_by=[backlog.record_model]
+        )
+
+    @classmethod
+    def get_oldest_date(cls, statuses, name):
+        # The dates aggregated by SQLite are not converted, so they are read
+        # from the oldest entries instead
+        IndexBacklog = Pool().get('elasticsearch.index_backlog')
+        dates = dict.fromkeys(map(int, statuses))
+        for backlog in IndexBacklog.search_read(
+                [('id', 'in', dates.keys())], fields_names=['create_date']):
+            dates[backlog['id']] = backlog['create_date']
+        return dates
+
+    def get_age(self, name):
+        if not self.oldest_date:
+            return 0
+        return (datetime.now() - self.oldest_date).total_seconds()
+
+    @classmethod
+    def get_statsd_metrics(cls):
+        """
+        Return the state of the backlog as a list of (name, value, type)
+        for statsd
+        """
+        metrics = []
+        for status in cls.search([]):
+            key = status.record_model.replace('.', '_')
+            metrics.extend([
+                ('%s.backlog.entries' % key, status.entries, 'g'),
+                ('%s.backlog.failing' % key, status.failing, 'g'),
+                ('%s.backlog.age' % key, int(status.age), 'g'),
+            ])
+        return metrics
+
+    @classmethod
+    def send_statsd_metrics(cls):
+        """
+        Send the state of the backlog to statsd if it is configured. The
+        indexer (and the cron when it is used instead) does it at regular
+        intervals rather than after every batch, as it reads the whole
+        backlog.
+        """
+        client = StatsdClient.get()
+        if client:
+            client.send(cls.get_statsd_metrics())
+
+
+class StatsdClient(object):
+    """
+    Sends metrics to a statsd server over UDP. The server is set with the
+    `statsd_host` and `statsd_port` (8125 by default) options of the
+    `elastic_search` section, and the names of the metrics start with the
+    `statsd_prefix` option (`trytond.elasticsearch` by default).
+    """
+    #: Number of metrics sent per packet
+    packet_size = 20
+
+    def __init__(self, host, port=8125, prefix='trytond.elasticsearch'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    @classmethod
+    def get(cls):
+        """
+        Return the client of the configured server for the current process,
+        or None if no server is configured
+        """
+        host = config.get('elastic_search', 'statsd_host')
+        if not host:
+            return None
+        key = (
+            host,
+            config.getint('elastic_search', 'statsd_port', 8125),
+            config.get(
+                'elastic_search', 'statsd_prefix', 'trytond.elasticsearch'
+            ),
+        )
+        with _statsd_clients_lock:
+            client = _statsd_clients.get(key)
+            if client is None:
+                client = _statsd_clients[key] = cls(*key)
+        return client
+
+    def send(self, metrics):
+        """
+        Send the metrics, without waiting for the server. Metrics that
+        cannot be sent are lost.
+
+        :param metrics: List of (name, value, type) tuples, the type being
+                        `c` for counters, `g` for gauges or `ms` for timings
+        """
+        lines = [
+            '%s.%s:%s|%s' % (self.prefix, name, value, type_)
+            for name, value, type_ in metrics
+        ]
+        for i in range(0, len(lines), self.packet_size):
+            try:
+                self.socket.sendto(
+                    '\n'.join(lines[i:i + self.packet_size]), self.address
+                )
+            except socket.error:
+                logging.getLogger('trytond.modules.elasticsearch').warning(
+                    'Metrics could not be sent to statsd', exc_info=True
+                )
+                return
+
+
+def prometheus_text():
+    """
+    Return the metrics of the indexing in the text format of Prometheus.
+
+    The documents and the times are summed over the batches still kept
+    (see `IndexBatch`), so they are exposed as gauges.
+    """
+    pool = Pool()
+    IndexBatch = pool.get('elasticsearch.index_batch')
+    IndexStatistics = pool.get('elasticsearch.index_statistics')
+    IndexBacklogStatus = pool.get('elasticsearch.index_backlog.status')
+    cursor = Transaction().cursor
+
+    metrics = defaultdict(list)
+
+    def add(name, value, **labels):
+        metrics[name].append((labels, value))
+
+    for status in IndexBacklogStatus.search([]):
+        model = status.record_model
+        add('backlog_entries', status.entries, model=model)
+        add('backlog_failing_entries', status.failing, model=model)
+        add('backlog_age_seconds', status.age, model=model)
+
+    for statistic in IndexStatistics.search([]):
+        model = statistic.record_model
+        for result in RESULTS:
+            add(
+                'documents', getattr(statistic, result) or 0,
+                model=model, result=result
+            )
+        add('json_seconds', statistic.json_time or 0, model=model)
+        add(
+            'slowest_json_seconds', statistic.slowest_json_time or 0,
+            model=model
+        )
+
+    batch = IndexBatch.__table__()
+    cursor.execute(*batch.select(
+        Count(batch.id), Sum(batch.entries), Sum(batch.duration),
+        *[Sum(Column(batch, '%s_time' % stage)) for stage in STAGES]
+    ))
+    row = cursor.fetchone()
+    add('batches', row[0] or 0)
+    add('batch_entries', row[1] or 0)
+    add('batch_seconds', row[2] or 0)
+    for stage, value in zip(STAGES, row[3:]):
+        add('batch_stage_seconds', value or 0, stage=stage)
+
+    lines = []
+    for name in sorted(metrics):
+        name_ = 'trytond_elasticsearch_%s' % name
+        lines.append('# TYPE %s gauge' % name_)
+        for labels, value in metrics[name]:
+            label_text = ','.join(
+                '%s="%s"' % (key, labels[key]) for key in sorted(labels)
+            )
+            lines.append('%s%s %s' % (
+                name_, '{%s}' % label_text if label_text else '', value
+            ))
+    return '\n'.join(lines) + '\n'
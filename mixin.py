@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+"""
+    mixin
+
+    Mixins for the models indexed in elastic search.
+
+    :copyright: © 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import time
+
+from pyes.exceptions import ElasticSearchException, NoServerAvailable
+
+from trytond.config import config
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+from .bulk import encode
+
+__all__ = ['ElasticSearchMixin', 'UnsupportedDomain', 'domain_to_filter']
+
+#: Tryton comparison operators and the matching keys of range filters
+RANGE_OPERATORS = {
+    '<': 'lt',
+    '<=': 'lte',
+    '>': 'gt',
+    '>=': 'gte',
+}
+
+#: Characters with a special meaning in the regular expressions of elastic
+#: search
+REGEXP_RESERVED = '.?+*|{}[]()"\\#@&<>~'
+
+
+class UnsupportedDomain(Exception):
+    """
+    Raised when a domain can not be translated into an elastic search
+    filter
+    """
+
+
+def domain_to_filter(domain):
+    """
+    Translate a Tryton domain into an elastic search filter, or return None
+    for an empty domain. The field names are the names of the fields of
+    the documents.
+
+    Only the clauses with the operators `=`, `!=`, `in`, `not in`, `<`,
+    `<=`, `>`, `>=` and the `like` and `ilike` patterns ending with the
+    only `%` are supported. A `like` pattern becomes a prefix filter and an
+    `ilike` pattern a regexp filter matching the prefix in any case, which
+    works on analyzed and not analyzed fields alike. Anything else raises
+    UnsupportedDomain.
+
+    :param domain: A Tryton domain
+    """
+    if not domain:
+        return None
+    if isinstance(domain, tuple):
+        return _clause_to_filter(domain)
+
+    operator = 'must'
+    if domain[0] in ('AND', 'OR'):
+        operator = 'must' if domain[0] == 'AND' else 'should'
+        domain = domain[1:]
+    filters = [f for f in map(domain_to_filter, domain) if f is not None]
+    if not filters:
+        return None
+    if len(filters) == 1:
+        return filters[0]
+    return {'bool': {operator: filters}}
+
+
+def _clause_to_filter(clause):
+    "Translate a single clause of a domain into a filter"
+    if len(clause) != 3:
+        raise UnsupportedDomain('Unsupported clause %r' % (clause,))
+    field, operator, value = clause
+
+    if operator in ('=', '!='):
+        if value is None:
+            filter_ = {'missing': {'field': field}}
+        else:
+            filter_ = {'term': {field: value}}
+    elif operator in ('in', 'not in'):
+        filter_ = {'terms': {field: list(value)}}
+    elif operator in RANGE_OPERATORS:
+        filter_ = {'range': {field: {RANGE_OPERATORS[operator]: value}}}
+    elif operator in ('like', 'ilike') and _is_prefix_pattern(value):
+        prefix = value[:-1]
+        if operator == 'ilike':
+            filter_ = {'regexp': {field: _any_case_regexp(prefix) + '.*'}}
+        else:
+            filter_ = {'prefix': {field: prefix}}
+    else:
+        raise UnsupportedDomain('Unsupported clause %r' % (clause,))
+
+    if operator in ('!=', 'not in'):
+        filter_ = {'not': filter_}
+    return filter_
+
+
+def _is_prefix_pattern(value):
+    "Return True if the like pattern only matches the values with a prefix"
+    return isinstance(value, basestring) and value.endswith('%') \
+        and '%' not in value[:-1] and '_' not in value
+
+
+def _any_case_regexp(text):
+    "Return the regular expression matching the text in any case"
+    regexp = []
+    for char in text:
+        cases = set([char, char.lower(), char.upper()])
+        cases = sorted(c for c in cases if len(c) == 1)
+        if len(cases) > 1:
+            regexp.append('[%s]' % ''.join(cases))
+        elif char in REGEXP_RESERVED:
+            regexp.append('\\' + char)
+        else:
+            regexp.append(char)
+    return ''.join(regexp)
+
+
+def _domain_field_names(domain):
+    "Return the names of the fields of the clauses of the domain"
+    if isinstance(domain, tuple):
+        return [domain[0]]
+    names = []
+    for item in domain or []:
+        if isinstance(item, (list, tuple)):
+            names.extend(_domain_field_names(item))
+    return names
+
+
+class ElasticSearchMixin(object):
+    """
+    A mixin for indexed models which adds the records created, written or
+    deleted to the index backlog directly, in bulk. Written records are
+    only added when the fields written are used to build their documents
+    (see the source fields of the document types). The records of the
+    related models of document type dependencies are always added, to
+    reindex the records depending on them.
+
+    The document types of the models using the mixin have no trigger, so
+    the models not indexed pay nothing but a lookup in a cached set. Models
+    without the mixin rely on triggers, which only handle the creations and
+    deletions since a trigger on write with an always true condition never
+    fires. A custom module can use this mixin to index all the changes::
+
+        from trytond.modules.elastic_search.mixin import ElasticSearchMixin
+
+        class Sale(ElasticSearchMixin):
+            __metaclass__ = PoolMeta
+            __name__ = 'sale.sale'
+
+    It also adds `search_es` to search the records in the index. Setting
+    `_es_search_rec_name` to True on the model makes the searches on the
+    `rec_name` use the index too.
+    """
+    _es_search_rec_name = False
+
+    @classmethod
+    def create(cls, vlist):
+        DocumentType = Pool().get('elasticsearch.document.type')
+        IndexBacklog = Pool().get('elasticsearch.index_backlog')
+
+        records = super(ElasticSearchMixin, cls).create(vlist)
+        with Transaction().set_user(0):
+            if cls.__name__ in DocumentType.get_indexed_models():
+                IndexBacklog.queue_records(records)
+        return records
+
+    @classmethod
+    def delete(cls, records):
+        DocumentType = Pool().get('elasticsearch.document.type')
+        IndexBacklog = Pool().get('elasticsearch.index_backlog')
+
+        # The ids are enough to remove the documents from the index
+        with Transaction().set_user(0):
+            if cls.__name__ in DocumentType.get_indexed_models():
+                IndexBacklog.queue_records(records)
+        super(ElasticSearchMixin, cls).delete(records)
+
+    @classmethod
+    def write(cls, records, values, *args):
+        DocumentType = Pool().get('elasticsearch.document.type')
+        IndexBacklog = Pool().get('elasticsearch.index_backlog')
+        Dependency = Pool().get('elasticsearch.document.type.dependency')
+
+        super(ElasticSearchMixin, cls).write(records, values, *args)
+
+        # The document types and the backlog are only readable by the
+        # elastic search administrators
+        with Transaction().set_user(0):
+            related = cls.__name__ in Dependency.get_related_models()
+            to_index = []
+            actions = iter((records, values) + args)
+            for records, values in zip(actions, actions):
+                if related or DocumentType.is_indexed_change(
+                        cls.__name__, values.keys()):
+                    to_index.extend(records)
+            if to_index:
+                IndexBacklog.queue_records(to_index)
+
+    @classmethod
+    def search_es(
+            cls, query, domain=None, offset=0, limit=None, order=None,
+            fallback=True):
+        """
+        Search the records matching the full text query in the index and
+        return their ids, the most relevant first unless an order is given.
+
+        When the index cannot answer (elastic search is not configured or
+        unreachable, or the domain cannot be translated), the records
+        whose rec_name contains the query are searched in the database
+        instead, unless fallback is False.
+
+        The results from the index are cached for the number of seconds of
+        the `search_cache_ttl` option of the `elastic_search` section (60
+        by default, 0 disables the cache) or until documents of the model
+        are indexed (see `Configuration.get_search_cache`).
+
+        :param query: Text to search for in all the fields of the documents
+        :param domain: Tryton domain on fields of the model which are in the
+                       documents under the same name, see
+                       `domain_to_filter`. The same domain is used to search
+                       the database.
+        :param offset: Number of matching records to skip
+        :param limit: Maximum number of ids returned. Without a limit, it
+                      is the `search_max_hits` option of the
+                      `elastic_search` section (1000 by default)
+        :param order: List of (field name, 'ASC' or 'DESC') tuples
+        :param fallback: Search the database when the index cannot answer
+        """
+        Configuration = Pool().get('elasticsearch.configuration')
+
+        unknown = set(
+            name.split('.')[0] for name in _domain_field_names(domain)
+        ).difference(cls._fields)
+        if unknown:
+            raise ValueError('Unknown fields %s of %s in domain' % (
+                ', '.join(sorted(unknown)), cls.__name__
+            ))
+
+        try:
+            ids, _ = cls._es_search(query, domain, offset, limit, order)
+        except (
+                UnsupportedDomain, ElasticSearchException,
+                NoServerAvailable):
+            if not fallback:
+                raise
+            Configuration.get_logger().warning(
+                'Searching %s in the database instead of the index' %
+                cls.__name__, exc_info=True
+            )
+            domain = [domain or []]
+            if query:
+                domain.append(('rec_name', 'ilike', '%%%s%%' % query))
+            return map(int, cls.search(
+                domain, offset=offset, limit=limit, order=order
+            ))
+        return ids
+
+    @classmethod
+    def _es_search(cls, query, domain, offset, limit, order):
+        """
+        Search the index like `search_es`, without falling back to the
+        database, and return the ids found and the total number of matching
+        documents.
+        """
+        Configuration = Pool().get('elasticsearch.configuration')
+
+        filter_ = domain_to_filter(domain)
+        conn = Configuration.get_es_connection()
+        if conn is None:
+            raise NoServerAvailable('Elastic search is not configured')
+
+        if limit is None:
+            limit = config.getint('elastic_search', 'search_max_hits', 1000)
+        body = cls._es_search_body(query, filter_, offset, limit, order)
+
+        index_name = Configuration(1).index_name
+        doc_type = Configuration.make_type_name(cls.__name__)
+        cache = Configuration.get_search_cache(doc_type)
+        key = (index_name, encode(body))
+        cached = cls._es_cache_get(cache, key)
+        if cached is not None:
+            return cached
+
+        hits = conn.search_raw(
+            body, indices=[index_name], doc_types=[doc_type]
+        )['hits']
+        ids = [int(hit['_id']) for hit in hits['hits']]
+        cls._es_cache_set(cache, key, ids, hits['total'])
+        return ids, hits['total']
+
+    @classmethod
+    def _es_search_body(cls, query, filter_, offset, limit, order):
+        """
+        Return the body of the search request of `search_es`
+
+        :param filter_: The filter translated from the domain or None
+        """
+        if query:
+            es_query = {'match': {'_all': {
+                'query': query, 'operator': 'and',
+            }}}
+        else:
+            es_query = {'match_all': {}}
+        if filter_ is not None:
+            es_query = {'filtered': {
+                'query': es_query, 'filter': filter_,
+            }}
+        body = {
+            'query': es_query,
+            'from': offset,
+            'size': limit,
+            'fields': [],
+        }
+        if order:
+            body['sort'] = [
+                {name: (direction or 'ASC').lower()}
+                for name, direction in order
+            ]
+        return body
+
+    @staticmethod
+    def _es_cache_get(cache, key):
+        """
+        Return the ids and the total cached for the search or None if they
+        are not cached or older than the `search_cache_ttl` option
+        """
+        ttl = config.getint('elastic_search', 'search_cache_ttl', 60)
+        cached = cache.get(key)
+        if cached is not None and time.time() - cached[0] < ttl:
+            return list(cached[1]), cached[2]
+        return None
+
+    @staticmethod
+    def _es_cache_set(cache, key, ids, total):
+        """
+        Cache the ids found by the search and the total number of matching
+        documents unless the cache is disabled
+        """
+        if config.getint('elastic_search', 'search_cache_ttl', 60) > 0:
+            cache.set(key, (time.time(), ids, total))
+
+    @classmethod
+    def search_rec_name(cls, name, clause):
+        if cls._es_search_rec_name and clause[1] in ('like', 'ilike') \
+                and isinstance(clause[2], basestring):
+            query = clause[2].replace('%', ' ').strip()
+            try:
+                ids, total = cls._es_search(query, None, 0, None, None)
+            except (ElasticSearchException, NoServerAvailable):
+                pass
+            else:
+                # Otherwise there are more matching records than the
+                # search_max_hits, which the database finds
+                if total <= len(ids):
+                    return [('id', 'in', ids)]
+        return super(ElasticSearchMixin, cls).search_rec_name(name, clause)
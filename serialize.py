@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+    serialize
+
+    Build the documents of records in a pool of worker processes, for
+    models whose `elastic_search_json` is expensive.
+
+    :copyright: © 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import multiprocessing
+import os
+import threading
+
+from trytond import backend
+from trytond.cache import Cache
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+__all__ = ['SerializerPool']
+
+# Pools of worker processes cached per process
+_pools = {}
+_pools_lock = threading.Lock()
+
+# Database connections inherited from the parent process. They are kept
+# referenced so that they are never closed by a worker, which would close
+# them for the parent too.
+_inherited_databases = {}
+
+# State of the transaction of the parent process when the worker was
+# forked, kept referenced for the same reason
+_inherited_transaction = {}
+
+
+def _init_worker():
+    "Make the worker open its own database connections and transactions"
+    Database = backend.get('Database')
+    databases = getattr(Database, '_databases', None)
+    if databases:
+        _inherited_databases.update(databases)
+        databases.clear()
+
+    # The worker is forked from a thread in a transaction, whose state is
+    # thread-local and so inherited. It is only forgotten: stopping the
+    # transaction would close the cursor of the parent.
+    transaction = Transaction()
+    _inherited_transaction.update(transaction.__dict__)
+    transaction.__dict__.clear()
+
+
+def _build_sources(task):
+    """
+    Build the encoded documents of records of a model in a transaction of
+    the worker and return them with the time spent building each of them
+    and the errors of the records which failed, if they are collected
+    """
+    (database_name, user_id, context, snapshot, model_name, ids,
+        collect_errors) = task
+    with Transaction().start(database_name, user_id, context=context):
+        if snapshot:
+            # Before any other query of the transaction
+            Transaction().cursor.execute(
+                'SET TRANSACTION SNAPSHOT %s', (snapshot,)
+            )
+        Cache.clean(database_name)
+        IndexBacklog = Pool().get('elasticsearch.index_backlog')
+        timings = {}
+        errors = {} if collect_errors else None
+        sources = IndexBacklog._build_sources(
+            model_name, ids, timings, errors
+        )
+        return sources, timings, errors
+
+
+class SerializerPool(object):
+    """
+    Splits the records to be indexed between worker processes, each of
+    which builds the documents in its own transaction and returns them
+    encoded as JSON. This lets the indexing use all the cores of the
+    machine when building the documents costs more than sending them.
+
+    The workers are forked from the process using the pool, which must be
+    the indexer process: forking a process while other threads hold locks
+    (like the threads of the trytond server, which also run the CRON
+    tasks and the buttons) can leave the workers deadlocked. The indexer
+    starts the pool before its own threads.
+    """
+
+    def __init__(self, processes):
+        self.processes = processes
+        self.pool = multiprocessing.Pool(processes, initializer=_init_worker)
+
+    @classmethod
+    def get(cls, processes):
+        """
+        Return the pool of the given number of processes of the current
+        process, starting it the first time
+        """
+        key = (os.getpid(), processes)
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = _pools[key] = cls(processes)
+        return pool
+
+    def build_sources(self, model_name, ids, timings=None, errors=None):
+        """
+        Return a map of id to the encoded document of the records of the
+        model. The ids of records that do not exist anymore are not in the
+        map.
+
+        The workers read the data with the user and the context of the
+        current transaction. On PostgreSQL they share its snapshot, so they
+        see the data committed when it started. The records they can not
+        see, like the ones written by the current transaction, are built by
+        the current process.
+
+        :param model_name: Name of the model of the records
+        :param ids: List of ids of the records
+        :param timings: A dictionary filled with the seconds spent building
+                        the document of each record, if given
+        :param errors: A dictionary filled with the errors of the records
+                       whose document could not be built, if given (see
+                       `IndexBacklog._get_sources`)
+        """
+        IndexBacklog = Pool().get('elasticsearch.index_backlog')
+        transaction = Transaction()
+        ids = sorted(set(ids))
+        chunk_size = -(-len(ids) // self.processes) or 1
+        snapshot = self.export_snapshot()
+        tasks = [(
+            transaction.cursor.dbname, transaction.user,
+            transaction.context, snapshot, model_name,
+            ids[i:i + chunk_size], errors is not None
+        ) for i in range(0, len(ids), chunk_size)]
+
+        sources = {}
+        failed = {} if errors is None else errors
+        for chunk_sources, chunk_timings, chunk_errors in self.pool.map(
+                _build_sources, tasks):
+            sources.update(chunk_sources)
+            if timings is not None:
+                timings.update(chunk_timings)
+            if errors is not None:
+                errors.update(chunk_errors)
+
+        missing = [id for id in ids if id not in sources and id not in failed]
+        if missing:
+            sources.update(IndexBacklog._build_sources(
+                model_name, missing, timings, errors
+            ))
+        return sources
+
+    @staticmethod
+    def export_snapshot():
+        """
+        Return the identifier of the snapshot of the current transaction
+        for the workers to import, or None if the database can not share
+        it (PostgreSQL 9.2 and later can)
+        """
+        cursor = Transaction().cursor
+        if backend.name() != 'postgresql' or \
+                cursor.connection.server_version < 90200:
+            return
+        cursor.execute('SELECT pg_export_snapshot()')
+        snapshot, = cursor.fetchone()
+        return snapshot
@@ -42,6 +42,61 @@ class SQLiteTest(Command):
         sys.exit(-1)
 
 
+class Benchmark(Command):
+    """
+    Run the benchmark of the indexing pipeline against a fake elastic
+    search server
+    """
+    description = "Benchmark the indexing pipeline"
+
+    user_options = [
+        ('scales=', None, 'comma separated numbers of records'),
+        ('backend=', None, 'sqlite or postgresql (database from the '
+            'TRYTOND_DATABASE_URI and DB_NAME environment variables)'),
+        ('latency=', None, 'seconds the fake server waits before answering'),
+        ('error-rate=', None, 'share of the requests failing (below 1)'),
+        ('item-error-rate=', None,
+            'share of the bulk items rejected with a 429 status'),
+        ('batch-size=', None, 'number of backlog entries indexed at a time'),
+    ]
+
+    def initialize_options(self):
+        self.scales = '1000'
+        self.backend = 'sqlite'
+        self.latency = 0
+        self.error_rate = 0
+        self.item_error_rate = 0
+        self.batch_size = 1000
+
+    def finalize_options(self):
+        self.scales = [int(s) for s in self.scales.split(',')]
+        self.latency = float(self.latency)
+        self.error_rate = float(self.error_rate)
+        self.item_error_rate = float(self.item_error_rate)
+        self.batch_size = int(self.batch_size)
+        if self.backend not in ('sqlite', 'postgresql'):
+            raise ValueError('Unknown backend %s' % self.backend)
+
+    def run(self):
+        if self.distribution.tests_require:
+            self.distribution.fetch_build_eggs(self.distribution.tests_require)
+
+        if self.backend == 'sqlite':
+            os.environ['TRYTOND_DATABASE_URI'] = 'sqlite://'
+            os.environ['DB_NAME'] = ':memory:'
+        else:
+            os.environ.setdefault(
+                'TRYTOND_DATABASE_URI', 'postgresql://'
+            )
+            os.environ.setdefault('DB_NAME', 'test_benchmark')
+
+        from tests.benchmark import main
+        main(
+            self.scales, latency=self.latency, error_rate=self.error_rate,
+            item_error_rate=self.item_error_rate, batch_size=self.batch_size
+        )
+
+
 config = ConfigParser.ConfigParser()
 config.readfp(open('tryton.cfg'))
 info = dict(config.items('tryton'))
@@ -53,7 +108,7 @@ major_version = int(major_version)
 minor_version = int(minor_version)
 
 requires = [
-    'pyes',
+    'pyes >= 0.99.6',
 ]
 for dep in info.get('depends', []):
     if not re.match(r'(ir|res|webdav)(\W|$)', dep):
@@ -106,10 +161,14 @@ setup(
     entry_points="""
     [trytond.modules]
     elastic_search = trytond.modules.elastic_search
+
+    [console_scripts]
+    trytond_elastic_search_indexer = trytond.modules.elastic_search.indexer:main
     """,
     test_suite='tests',
     test_loader='trytond.test_loader:Loader',
     cmdclass={
         'test': SQLiteTest,
+        'benchmark': Benchmark,
     },
 )
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmark
+
+    Measure the indexing pipeline against a fake elastic search server.
+
+    Usage::
+
+        python setup.py benchmark --scales=1000,100000
+
+    :copyright: © 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import resource
+import time
+from contextlib import contextmanager
+
+from sql import Literal
+from sql.functions import Now
+
+import trytond.tests.test_tryton
+from trytond.tests.test_tryton import POOL, DB_NAME, USER, CONTEXT
+from trytond.config import config
+from trytond.transaction import Transaction
+
+from .fake_es import FakeElasticSearch
+
+__all__ = ['Benchmark', 'main']
+
+MODEL = 'res.group'
+
+
+class Benchmark(object):
+    """
+    Runs the scenarios of the indexing pipeline on records of `res.group`
+    and reports, for each of them, the records handled per second, the
+    number of SQL queries and of HTTP requests, and the peak memory of the
+    process.
+
+    The scenarios are run in one transaction per scale, which is rolled
+    back at the end:
+
+    * `trigger`: the records are created with the ORM and added to the
+      backlog by the trigger of the document type
+    * `create_from_records`: the records are added to the backlog
+    * `update_index`: the backlog is drained
+    * `update_index (unchanged)`: the backlog is drained again after adding
+      the same records, whose documents are not sent again
+    * `reindex_all_records`: all the records are added to the backlog
+      and the backlog is drained
+    """
+
+    def __init__(self, fake, batch_size=1000, chunk_size=1000):
+        self.fake = fake
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.queries = 0
+        self.results = []
+
+    def setup(self):
+        "Install the module, using the fake server"
+        if not config.has_section('elastic_search'):
+            config.add_section('elastic_search')
+        config.set('elastic_search', 'server_uri', self.fake.uri)
+        trytond.tests.test_tryton.install_module('elastic_search')
+
+    @contextmanager
+    def count_queries(self):
+        "Count the SQL queries run on the cursor of the transaction"
+        cursor = Transaction().cursor
+        execute = cursor.execute
+
+        def counting_execute(*args, **kwargs):
+            self.queries += 1
+            return execute(*args, **kwargs)
+
+        cursor.execute = counting_execute
+        try:
+            yield
+        finally:
+            del cursor.execute
+
+    @contextmanager
+    def measure(self, scale, name):
+        """
+        Measure a scenario, whose body appends the number of records
+        handled to the yielded list
+        """
+        self.queries = 0
+        self.fake.reset()
+        count = []
+        start = time.time()
+        yield count
+        duration = time.time() - start
+        self.results.append({
+            'scale': scale,
+            'scenario': name,
+            'records': sum(count),
+            'duration': duration,
+            'rate': sum(count) / duration if duration else 0,
+            'queries': self.queries,
+            'requests': self.fake.request_count,
+            'memory': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        })
+
+    def seed(self, scale):
+        "Insert the records of the model with plain SQL and return their ids"
+        Group = POOL.get(MODEL)
+        cursor = Transaction().cursor
+        table = Group.__table__()
+
+        for i in range(0, scale, self.chunk_size):
+            cursor.execute(*table.insert(
+                [table.name, table.create_uid, table.create_date],
+                [[
+                    'benchmark seed %d' % j, Literal(USER), Now()
+                ] for j in range(i, min(i + self.chunk_size, scale))]
+            ))
+        return map(int, Group.search([
+            ('name', 'like', 'benchmark seed %'),
+        ], order=[('id', 'ASC')]))
+
+    def drain(self):
+        "Index the backlog until it is empty and return the entries handled"
+        IndexBacklog = POOL.get('elasticsearch.index_backlog')
+        handled = 0
+        while True:
+            count = IndexBacklog.update_index(self.batch_size)
+            if not count:
+                return handled
+            handled += count
+
+    def run_scale(self, scale):
+        "Run all the scenarios on the given number of records"
+        Model = POOL.get('ir.model')
+        DocumentType = POOL.get('elasticsearch.document.type')
+        IndexBacklog = POOL.get('elasticsearch.index_backlog')
+        Configuration = POOL.get('elasticsearch.configuration')
+        Group = POOL.get(MODEL)
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            Configuration(1).save()
+            model, = Model.search([('model', '=', MODEL)])
+            document_type, = DocumentType.create([{
+                'name': 'Benchmark',
+                'model': model.id,
+            }])
+
+            with self.count_queries():
+                with self.measure(scale, 'trigger') as count:
+                    for i in range(0, scale, self.chunk_size):
+                        count.append(len(Group.create([{
+                            'name': 'benchmark trigger %d' % j,
+                        } for j in range(i, min(i + self.chunk_size, scale))
+                        ])))
+                # The backlog has to be empty for the next scenarios
+                self.drain()
+
+                ids = self.seed(scale)
+                with self.measure(scale, 'create_from_records') as count:
+                    for i in range(0, len(ids), self.chunk_size):
+                        records = Group.browse(ids[i:i + self.chunk_size])
+                        IndexBacklog.create_from_records(records)
+                        count.append(len(records))
+
+                with self.measure(scale, 'update_index') as count:
+                    count.append(self.drain())
+
+                IndexBacklog.create_from_ids(MODEL, ids)
+                with self.measure(scale, 'update_index (unchanged)') as count:
+                    count.append(self.drain())
+
+                with self.measure(scale, 'reindex_all_records') as count:
+                    DocumentType.reindex_all_records([document_type])
+                    count.append(self.drain())
+
+            Transaction().cursor.rollback()
+
+    def report(self):
+        "Return the results as a table"
+        header = (
+            'scale', 'scenario', 'records', 'seconds', 'records/s',
+            'queries', 'requests', 'peak memory (KB)'
+        )
+        rows = [header] + [(
+            str(r['scale']), r['scenario'], str(r['records']),
+            '%.2f' % r['duration'], '%.0f' % r['rate'], str(r['queries']),
+            str(r['requests']), str(r['memory']),
+        ) for r in self.results]
+        widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+        return '\n'.join(
+            '  '.join(cell.ljust(width) for cell, width in zip(row, widths))
+            for row in rows
+        )
+
+
+def main(
+        scales=(1000,), latency=0, error_rate=0, item_error_rate=0,
+        batch_size=1000):
+    """
+    Run the benchmark at each scale and print the results
+
+    :param scales: Numbers of records to run the scenarios on
+    :param latency: Seconds the fake server waits before answering
+    :param error_rate: Share of the requests failing
+    :param item_error_rate: Share of the items of bulk requests rejected
+        with a 429 status
+    :param batch_size: Number of backlog entries indexed at a time
+    """
+    fake = FakeElasticSearch(
+        latency=latency, error_rate=error_rate,
+        item_error_rate=item_error_rate
+    ).start()
+    try:
+        benchmark = Benchmark(fake, batch_size=batch_size)
+        benchmark.setup()
+        for scale in scales:
+            benchmark.run_scale(scale)
+    finally:
+        fake.stop()
+    print benchmark.report()
@@ -0,0 +1,452 @@
+# -*- coding: utf-8 -*-
+"""
+    fake_es
+
+    An in-process stand-in for the elastic search HTTP API, to run the
+    benchmarks without a cluster.
+
+    :copyright: © 2014 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import json
+import random
+import re
+import socket
+import threading
+import time
+import urllib
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler
+from collections import defaultdict
+from SocketServer import ThreadingMixIn, TCPServer
+
+__all__ = ['FakeElasticSearch']
+
+ACKNOWLEDGED = {'acknowledged': True, 'ok': True}
+
+
+class _Server(ThreadingMixIn, TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, *args, **kwargs):
+        TCPServer.__init__(self, *args, **kwargs)
+        #: Map of the sockets of the connections being served to the thread
+        #: serving them
+        self.connections = {}
+        self.connections_lock = threading.Lock()
+        self.stopped = False
+
+    def process_request_thread(self, request, client_address):
+        with self.connections_lock:
+            self.connections[request] = threading.current_thread()
+        try:
+            ThreadingMixIn.process_request_thread(
+                self, request, client_address
+            )
+        finally:
+            with self.connections_lock:
+                self.connections.pop(request, None)
+
+    def handle_error(self, request, client_address):
+        # The connections closed under the handlers when stopping make them
+        # fail
+        if not self.stopped:
+            TCPServer.handle_error(self, request, client_address)
+
+    def close_connections(self):
+        """
+        Close the connections kept alive by the clients and wait for their
+        threads to end
+        """
+        self.stopped = True
+        with self.connections_lock:
+            connections = self.connections.items()
+        for request, thread in connections:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        for request, thread in connections:
+            thread.join()
+
+
+class FakeElasticSearch(object):
+    """
+    A fake elastic search server running in a thread of the current
+    process. It keeps the documents in memory and handles the endpoints used
+    by the module: `_bulk`, the indexing and deletion of single documents,
+    `_search` (see `matches`), mappings, settings, aliases, refresh, the
+    health of the cluster and the creation, existence and deletion of
+    indices.
+
+    Every request waits `latency` seconds before being answered. A share
+    of `error_rate` of the requests fail with `error_status` and a share of
+    `item_error_rate` of the items of the bulk requests are rejected with
+    `item_error_status` (429 by default, which asks for a retry). To fail
+    on purpose, set `pending_errors` or `pending_item_errors` to the number
+    of the next requests or bulk items which must fail.
+
+    The number of requests per endpoint is counted in `requests`.
+    """
+
+    def __init__(
+            self, host='localhost', port=0, latency=0, error_rate=0,
+            error_status=503, item_error_rate=0, item_error_status=429):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.item_error_rate = item_error_rate
+        self.item_error_status = item_error_status
+        #: Number of the next requests failing with `error_status`
+        self.pending_errors = 0
+        #: Number of the next bulk items rejected with `item_error_status`
+        self.pending_item_errors = 0
+
+        #: Number of requests per endpoint
+        self.requests = defaultdict(int)
+        #: Map of (index, type, id) to the source of the documents
+        self.documents = {}
+        #: Map of index to its settings and mappings
+        self.indices = {}
+        #: Map of alias to the names of the indices
+        self.aliases = defaultdict(set)
+
+        self.lock = threading.Lock()
+        self.server = _Server((host, port), self._make_handler())
+        self.thread = None
+
+    @property
+    def uri(self):
+        "The URI to set as `server_uri` of the `elastic_search` section"
+        host, port = self.server.server_address
+        return 'http://%s:%s' % (host, port)
+
+    @property
+    def request_count(self):
+        "The total number of requests received"
+        return sum(self.requests.values())
+
+    def start(self):
+        "Start serving in a daemon thread"
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        "Stop serving"
+        self.server.shutdown()
+        self.server.server_close()
+        self.server.close_connections()
+        self.thread.join()
+
+    def reset(self):
+        "Forget the documents and the request counts"
+        with self.lock:
+            self.requests.clear()
+            self.documents.clear()
+
+    def resolve(self, name):
+        "Return the names of the indices of an index name or an alias"
+        if name in self.aliases:
+            return sorted(self.aliases[name])
+        return [name]
+
+    def inject_error(self, pending, rate):
+        """
+        Return True if the next request or item must fail, either because
+        errors are pending or at random. It is called with the lock held.
+
+        :param pending: Name of the attribute counting the pending errors
+        :param rate: Share of the requests or items which fail at random
+        """
+        if getattr(self, pending):
+            setattr(self, pending, getattr(self, pending) - 1)
+            return True
+        return bool(rate) and random.random() < rate
+
+    def _make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def _handle(self, method):
+                path = urlparse.urlparse(self.path).path
+                parts = [urllib.unquote(p) for p in path.split('/') if p]
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else ''
+
+                if fake.latency:
+                    time.sleep(fake.latency)
+                endpoint = fake.get_endpoint(method, parts)
+                with fake.lock:
+                    fake.requests[endpoint] += 1
+                    failing = fake.inject_error(
+                        'pending_errors', fake.error_rate
+                    )
+
+                if failing:
+                    status, result = fake.error_status, {
+                        'error': 'Injected error', 'status': fake.error_status
+                    }
+                else:
+                    status, result = fake.dispatch(
+                        method, endpoint, parts, body
+                    )
+
+                data = '' if method == 'HEAD' else json.dumps(result)
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self._handle('GET')
+
+            def do_POST(self):
+                self._handle('POST')
+
+            def do_PUT(self):
+                self._handle('PUT')
+
+            def do_DELETE(self):
+                self._handle('DELETE')
+
+            def do_HEAD(self):
+                self._handle('HEAD')
+
+        return Handler
+
+    @staticmethod
+    def get_endpoint(method, parts):
+        "Return the name of the endpoint of a request"
+        specials = [p for p in parts if p.startswith('_')]
+        if specials:
+            return specials[-1]
+        if not parts:
+            return 'root'
+        if len(parts) == 1:
+            return '%s_index' % method.lower()
+        return '%s_document' % method.lower()
+
+    def dispatch(self, method, endpoint, parts, body):
+        "Return the status and the result of a request"
+        with self.lock:
+            handler = getattr(self, 'do%s' % endpoint, None)
+            if handler is None:
+                handler = getattr(self, 'do_%s' % endpoint, None)
+            if handler is None:
+                return 400, {'error': 'No handler for %s' % endpoint}
+            return handler(method, parts, body)
+
+    def do_root(self, method, parts, body):
+        return 200, {'version': {'number': '1.4.0'}, 'status': 200}
+
+    def do_head_index(self, method, parts, body):
+        name, = parts
+        exists = name in self.indices or name in self.aliases
+        return (200 if exists else 404), {}
+
+    def do_put_index(self, method, parts, body):
+        name, = parts
+        self.indices[name] = {
+            'settings': json.loads(body or '{}'), 'mappings': {},
+        }
+        return 200, ACKNOWLEDGED
+
+    def do_delete_index(self, method, parts, body):
+        name, = parts
+        for index in self.resolve(name):
+            self.indices.pop(index, None)
+            for key in [k for k in self.documents if k[0] == index]:
+                del self.documents[key]
+        for indices in self.aliases.values():
+            indices.discard(name)
+        return 200, ACKNOWLEDGED
+
+    def do_put_document(self, method, parts, body):
+        index, doc_type, id = parts[:3]
+        for name in self.resolve(index):
+            self.documents[(name, doc_type, id)] = body
+        return 201, {'_index': index, '_type': doc_type, '_id': id}
+
+    do_post_document = do_put_document
+
+    def do_delete_document(self, method, parts, body):
+        index, doc_type, id = parts[:3]
+        found = False
+        for name in self.resolve(index):
+            found |= self.documents.pop((name, doc_type, id), None) is not None
+        return (200 if found else 404), {'found': found}
+
+    def do_bulk(self, method, parts, body):
+        lines = iter(line for line in body.split('\n') if line)
+        items = []
+        for line in lines:
+            (action, header), = json.loads(line).items()
+            key = (header['_index'], header['_type'], str(header['_id']))
+            if action != 'delete':
+                source = next(lines)
+
+            if self.inject_error('pending_item_errors', self.item_error_rate):
+                status = self.item_error_status
+                item = {'status': status, 'error': 'Injected error'}
+            elif action == 'delete':
+                found = False
+                for name in self.resolve(key[0]):
+                    found |= self.documents.pop(
+                        (name,) + key[1:], None
+                    ) is not None
+                item = {'status': 200 if found else 404, 'found': found}
+            elif action == 'create' and any(
+                    (name,) + key[1:] in self.documents
+                    for name in self.resolve(key[0])):
+                item = {'status': 409, 'error': 'DocumentAlreadyExists'}
+            else:
+                for name in self.resolve(key[0]):
+                    self.documents[(name,) + key[1:]] = source
+                item = {'status': 201}
+            item.update({'_index': key[0], '_type': key[1], '_id': key[2]})
+            items.append({action: item})
+        errors = any('error' in item.values()[0] for item in items)
+        return 200, {'took': 1, 'errors': errors, 'items': items}
+
+    def do_search(self, method, parts, body):
+        index = parts[0] if parts[0] != '_search' else None
+        doc_type = parts[1] if len(parts) > 2 else None
+        query = json.loads(body or '{}')
+        size = query.get('size', 10)
+        offset = query.get('from', 0)
+
+        indices = self.resolve(index) if index else None
+        hits = []
+        for key, source in sorted(self.documents.iteritems()):
+            if indices is not None and key[0] not in indices:
+                continue
+            if doc_type is not None and key[1] != doc_type:
+                continue
+            if not self.matches(json.loads(source), query.get('query', {})):
+                continue
+            hits.append({
+                '_index': key[0], '_type': key[1], '_id': key[2],
+                '_score': 1.0,
+            })
+        return 200, {
+            'took': 1,
+            'hits': {
+                'total': len(hits),
+                'max_score': 1.0,
+                'hits': hits[offset:offset + size],
+            },
+        }
+
+    @classmethod
+    def matches(cls, source, query):
+        """
+        Return True if the document matches the query. Only the term, terms,
+        match and match_all queries and the bool and filtered queries are
+        evaluated, on the words of the values. Any other query matches all
+        the documents.
+        """
+        if not query:
+            return True
+        (name, value), = query.items()
+        if name == 'bool':
+            return all(
+                cls.matches(source, q) for q in value.get('must', [])
+            ) and not any(
+                cls.matches(source, q) for q in value.get('must_not', [])
+            ) and (not value.get('should') or any(
+                cls.matches(source, q) for q in value['should']
+            ))
+        if name == 'filtered':
+            return cls.matches(source, value.get('query')) and \
+                cls.matches(source, value.get('filter'))
+        if name in ('term', 'terms', 'match'):
+            (field, terms), = value.items()
+            every = False
+            if name == 'match':
+                if isinstance(terms, dict):
+                    every = terms.get('operator') == 'and'
+                    terms = terms['query']
+                terms = cls.get_words(terms)
+            elif name == 'term':
+                terms = [terms]
+            if field == '_all':
+                values = source.values()
+            else:
+                values = [source.get(field)]
+            words = set()
+            for field_value in values:
+                words.update(cls.get_words(field_value))
+                words.add(unicode(field_value).lower())
+            found = [unicode(term).lower() in words for term in terms]
+            return all(found) if every else any(found)
+        return True
+
+    @staticmethod
+    def get_words(value):
+        "Return the lower case words of a value, as an analyzer would"
+        return re.findall(r'\w+', unicode(value).lower(), re.UNICODE)
+
+    def do_cluster(self, method, parts, body):
+        return 200, {'status': 'green', 'timed_out': False}
+
+    def do_mapping(self, method, parts, body):
+        index = parts[0]
+        if method == 'GET':
+            return 200, dict(
+                (name, {'mappings': self.indices.get(name, {}).get(
+                    'mappings', {}
+                )}) for name in self.resolve(index)
+            )
+        for name in self.resolve(index):
+            self.indices.setdefault(name, {'settings': {}, 'mappings': {}})
+            self.indices[name]['mappings'].update(json.loads(body or '{}'))
+        return 200, ACKNOWLEDGED
+
+    def do_settings(self, method, parts, body):
+        index = parts[0]
+        if method == 'GET':
+            return 200, dict(
+                (name, {'settings': self.indices.get(name, {}).get(
+                    'settings', {}
+                )}) for name in self.resolve(index)
+            )
+        for name in self.resolve(index):
+            settings = self.indices.setdefault(
+                name, {'settings': {}, 'mappings': {}}
+            )['settings']
+            settings.setdefault('index', {}).update(
+                json.loads(body or '{}').get('index', {})
+            )
+        return 200, ACKNOWLEDGED
+
+    def do_aliases(self, method, parts, body):
+        if method == 'GET':
+            return 200, dict(
+                (index, {'aliases': dict(
+                    (alias, {}) for alias, indices in self.aliases.items()
+                    if index in indices
+                )}) for index in self.indices
+            )
+        for action in json.loads(body or '{}').get('actions', []):
+            (name, value), = action.items()
+            if name == 'add':
+                self.aliases[value['alias']].add(value['index'])
+            elif name == 'remove':
+                self.aliases[value['alias']].discard(value['index'])
+                if not self.aliases[value['alias']]:
+                    del self.aliases[value['alias']]
+        return 200, ACKNOWLEDGED
+
+    def do_refresh(self, method, parts, body):
+        return 200, {'_shards': {'total': 1, 'successful': 1, 'failed': 0}}
+
+    do_open = do_close = do_refresh
@@ -7,15 +7,27 @@
     :copyright: (c) 2013 by Openlabs Technologies & Consulting (P) Limited
     :license: BSD, see LICENSE for more details.
 """
+import json
+import socket
 import time
 import unittest
-from pyes import TermQuery
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from pyes import ES, TermQuery
 
 import trytond.tests.test_tryton
 from trytond.tests.test_tryton import POOL, DB_NAME, USER, CONTEXT, test_view,\
     test_depends
 from trytond.transaction import Transaction
 from trytond.config import config
+from trytond.exceptions import UserError
+from trytond.modules.elastic_search.bulk import BulkRequest, encode, \
+    _adapt_dumps
+from trytond.modules.elastic_search.indexer import Indexer
+from trytond.modules.elastic_search.metrics import prometheus_text
+from trytond.modules.elastic_search.mixin import UnsupportedDomain, \
+    domain_to_filter
+from .fake_es import FakeElasticSearch
 
 config.add_section('elastic_search')
 config.set('elastic_search', 'server_uri', 'http://localhost:9200')
@@ -62,6 +74,357 @@ class IndexBacklogTestCase(unittest.TestCase):
             self.IndexBacklog.update_index()
             self.assertEqual(len(self.IndexBacklog.search([])), 0)
 
+    def test_0020_create_from_records_duplicates(self):
+        """
+        Records already in the backlog or passed more than once are queued
+        only once
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            users = self.User.create([{
+                'name': 'user1', 'login': 'user1'
+            }, {
+                'name': 'user2', 'login': 'user2'
+            }])
+            self.IndexBacklog.create_from_records(users[:1])
+            self.assertEqual(len(self.IndexBacklog.search([])), 1)
+
+            backlogs = self.IndexBacklog.create_from_records(users + users)
+            self.assertEqual(len(backlogs), 1)
+            self.assertEqual(backlogs[0].record_id, users[1].id)
+            self.assertEqual(len(self.IndexBacklog.search([])), 2)
+
+    def test_0025_queue_records(self):
+        """
+        Records queued again by the same transaction are skipped until the
+        backlog entries are deleted
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            users = self.User.create([{
+                'name': 'user1', 'login': 'user1'
+            }, {
+                'name': 'user2', 'login': 'user2'
+            }])
+            self.IndexBacklog.queue_records(users[:1])
+            self.IndexBacklog.queue_records(users + users)
+            self.assertEqual(len(self.IndexBacklog.search([])), 2)
+
+            self.IndexBacklog.delete(self.IndexBacklog.search([]))
+            self.IndexBacklog.queue_records(users)
+            self.assertEqual(len(self.IndexBacklog.search([])), 2)
+
+            # A record can only be once in the backlog
+            self.assertRaises(UserError, self.IndexBacklog.create, [{
+                'record_model': 'res.user',
+                'record_id': users[0].id,
+            }])
+
+            # The entries rolled back are queued again by the cursor
+            Transaction().cursor.rollback()
+            self.assertEqual(len(self.IndexBacklog.search([])), 0)
+            self.IndexBacklog.queue_records(users)
+            self.assertEqual(len(self.IndexBacklog.search([])), 2)
+
+    def test_0027_concurrent_queue(self):
+        """
+        Records queued by a concurrent transaction since they were checked
+        are skipped instead of failing the insert
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            users = self.User.create([{
+                'name': 'user1', 'login': 'user1'
+            }, {
+                'name': 'user2', 'login': 'user2'
+            }])
+            self.IndexBacklog.queue_records(users[:1])
+
+            # The check does not see the entry, as if it was committed by
+            # another transaction in the meantime
+            get_unqueued_ids = self.IndexBacklog._get_unqueued_ids
+            self.IndexBacklog._get_unqueued_ids = staticmethod(
+                lambda model_name, ids: sorted(set(ids))
+            )
+            try:
+                self.IndexBacklog.create_from_records(users)
+                self.IndexBacklog._get_transaction_queued().clear()
+                self.IndexBacklog.queue_records(users)
+            finally:
+                self.IndexBacklog._get_unqueued_ids = classmethod(
+                    get_unqueued_ids.im_func
+                )
+            self.assertEqual(
+                sorted(b.record_id for b in self.IndexBacklog.search([])),
+                sorted(u.id for u in users)
+            )
+
+    def test_0030_failed_backlog(self):
+        """
+        Backlog entries which fail to index stay in the backlog with the
+        number of attempts and the last error
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            users = self.User.create([{
+                'name': 'user1', 'login': 'user1'
+            }, {
+                'name': 'user2', 'login': 'user2'
+            }])
+            backlog1, backlog2 = self.IndexBacklog.create_from_records(users)
+            self.assertEqual(backlog1.attempts, 0)
+
+            self.IndexBacklog._mark_failed({backlog1.id: 'Some Error'})
+            self.IndexBacklog._mark_failed({backlog1.id: 'Another Error'})
+            self.IndexBacklog._delete_processed([backlog2.id])
+
+            backlog, = self.IndexBacklog.search([])
+            self.assertEqual(backlog.id, backlog1.id)
+            self.assertEqual(backlog.attempts, 2)
+            self.assertEqual(backlog.last_error, 'Another Error')
+
+            # The failed entry is not claimed again before its next attempt
+            self.assertTrue(backlog.next_attempt > datetime.now())
+            self.assertEqual(self.IndexBacklog._claim_entries(10), [])
+            self.IndexBacklog.write([backlog], {
+                'next_attempt': datetime.now() - timedelta(seconds=1),
+            })
+            item, = self.IndexBacklog._claim_entries(10)
+            self.assertEqual(item['id'], backlog.id)
+
+            # and it is dropped after too many attempts
+            config.set('elastic_search', 'max_attempts', '3')
+            try:
+                self.IndexBacklog._mark_failed({backlog.id: 'Last Error'})
+            finally:
+                config.remove_option('elastic_search', 'max_attempts')
+            self.assertEqual(self.IndexBacklog.search([]), [])
+
+    def test_0035_get_sources(self):
+        """
+        Documents are encoded for the existing records only
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.Configuration(1).save()
+            user1, user2 = self.User.create([{
+                'name': 'user1', 'login': 'user1'
+            }, {
+                'name': 'user2', 'login': 'user2'
+            }])
+            self.User.delete([user2])
+
+            sources = self.IndexBacklog._get_sources(
+                'res.user', [user1.id, user2.id]
+            )
+            self.assertEqual(sources, {user1.id: '{"rec_name":"user1"}'})
+
+    def test_0037_serialize_processes(self):
+        """
+        Documents are built by worker processes forked in a transaction
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.Configuration.write([self.Configuration(1)], {
+                'serialize_processes': 1,
+            })
+            # A committed record, which the workers see
+            admin = self.User(USER)
+            self.IndexBacklog.create_from_records([admin])
+
+            self.assertEqual(
+                self.IndexBacklog._get_sources('res.user', [admin.id]),
+                {admin.id: '{"rec_name":"%s"}' % admin.rec_name}
+            )
+            self.assertEqual(self.IndexBacklog.update_index(), 1)
+            self.assertEqual(self.IndexBacklog.search([]), [])
+
+            # The records the workers can not see are built by the process
+            user, = self.User.create([{'name': 'user1', 'login': 'user1'}])
+            self.assertEqual(
+                self.IndexBacklog._get_sources('res.user', [user.id]),
+                {user.id: '{"rec_name":"user1"}'}
+            )
+
+    def test_0040_connection_cache(self):
+        """
+        Connections are reused until the configuration changes
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            configuration = self.Configuration(1)
+            configuration.save()
+
+            conn = self.Configuration.get_es_connection()
+            self.assertIs(self.Configuration.get_es_connection(), conn)
+            self.assertIsNot(
+                self.Configuration.get_es_connection(timeout=5), conn
+            )
+
+            self.Configuration.write([configuration], {'bulk_size': 100})
+            self.assertIsNot(self.Configuration.get_es_connection(), conn)
+
+    def test_0045_search_cache(self):
+        """
+        Search results are cached per document type until it is cleared
+        """
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            cache = self.Configuration.get_search_cache('res_user')
+            self.assertIs(
+                self.Configuration.get_search_cache('res_user'), cache
+            )
+            other_cache = self.Configuration.get_search_cache('res_group')
+            cache.set('key', [1, 2])
+            other_cache.set('key', [3])
+
+            self.Configuration.clear_search_caches(['res_user'])
+            self.assertIsNone(cache.get('key'))
+            self.assertEqual(other_cache.get('key'), [3])
+
+    def test_0050_encode(self):
+        """
+        Values of Tryton fields are encoded as they are
+        """
+        self.assertEqual(
+            encode({
+                'price': Decimal('10.5'),
+                'date': date(2014, 5, 1),
+                'create_date': datetime(2014, 5, 1, 10, 30),
+                'name': u'Caf\xe9',
+            }),
+            '{"create_date":"2014-05-01T10:30:00","date":"2014-05-01",'
+            '"name":"Caf\\u00e9","price":10.5}'
+        )
+        self.assertRaises(TypeError, encode, {'value': object()})
+
+    def test_0055_adapt_dumps(self):
+        """
+        The dumps functions without a default function are given converted
+        values and those which can not sort the keys are refused
+        """
+        def ujson_dumps(obj, sort_keys=False):
+            return json.dumps(obj, sort_keys=sort_keys, separators=(',', ':'))
+
+        self.assertEqual(
+            _adapt_dumps(ujson_dumps, 'ujson')({
+                'price': Decimal('10.5'),
+                'dates': [date(2014, 5, 1)],
+            }),
+            '{"dates":["2014-05-01"],"price":10.5}'
+        )
+
+        def cjson_dumps(obj):
+            return json.dumps(obj, separators=(',', ':'))
+
+        self.assertRaises(ValueError, _adapt_dumps, cjson_dumps, 'cjson')
+
+    def test_0060_domain_to_filter(self):
+        """
+        Simple domains are translated into filters
+        """
+        self.assertIsNone(domain_to_filter([]))
+        self.assertEqual(
+            domain_to_filter([('state', '=', 'done')]),
+            {'term': {'state': 'done'}}
+        )
+        self.assertEqual(
+            domain_to_filter([
+                'OR',
+                ('state', 'not in', ['draft', 'cancel']),
+                [('total', '>=', 10), ('code', 'ilike', 'SO%')],
+            ]),
+            {'bool': {'should': [
+                {'not': {'terms': {'state': ['draft', 'cancel']}}},
+                {'bool': {'must': [
+                    {'range': {'total': {'gte': 10}}},
+                    {'regexp': {'code': '[Ss][Oo].*'}},
+                ]}},
+            ]}}
+        )
+        self.assertEqual(
+            domain_to_filter([('party', '!=', None)]),
+            {'not': {'missing': {'field': 'party'}}}
+        )
+        self.assertEqual(
+            domain_to_filter([('code', 'like', 'SO-1.%')]),
+            {'prefix': {'code': 'SO-1.'}}
+        )
+        self.assertEqual(
+            domain_to_filter([('code', 'ilike', 'SO-1.%')]),
+            {'regexp': {'code': '[Ss][Oo]-1\\..*'}}
+        )
+        self.assertRaises(
+            UnsupportedDomain, domain_to_filter,
+            [('name', 'ilike', '%foo%')]
+        )
+        self.assertRaises(
+            UnsupportedDomain, domain_to_filter, [('name', 'like', None)]
+        )
+
+    def test_0070_failing_bulk(self):
+        """
+        The entries which failed are not counted as done
+        """
+        def send(bulk, actions):
+            bulk._record([], [(key, 'Unavailable') for key, _ in actions])
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.Configuration(1).save()
+            users = self.User.create([{
+                'name': 'user1', 'login': 'user1'
+            }, {
+                'name': 'user2', 'login': 'user2'
+            }])
+            self.IndexBacklog.create_from_records(users)
+
+            original_send = BulkRequest.send
+            BulkRequest.send = send
+            try:
+                self.assertEqual(self.IndexBacklog.update_index(), 0)
+            finally:
+                BulkRequest.send = original_send
+            self.assertEqual(len(self.IndexBacklog.search([])), 2)
+
+    def test_0075_indexer_backoff(self):
+        """
+        The indexer only goes on without waiting when the batch removed
+        entries from the backlog and backs off after failures
+        """
+        indexer = Indexer(
+            DB_NAME, min_batch_size=10, max_batch_size=40, min_sleep=1,
+            max_sleep=8, target_duration=10
+        )
+        waits = []
+        indexer.wait = waits.append
+
+        # Full batches of entries done grow the batch size
+        indexer.update_index = lambda: indexer.batch_size
+        self.assertEqual(indexer.step(4), 1)
+        self.assertEqual(indexer.step(1), 1)
+        self.assertEqual(indexer.batch_size, 40)
+        self.assertEqual(waits, [])
+
+        # Batches whose entries all failed back off
+        indexer.update_index = lambda: 0
+        self.assertEqual(indexer.step(1), 2)
+        self.assertEqual(indexer.step(2), 4)
+        self.assertEqual(indexer.step(4), 8)
+        self.assertEqual(indexer.step(8), 8)
+        self.assertEqual(waits, [1, 2, 4, 8])
+        self.assertEqual(indexer.batch_size, 40)
+
+        # Errors back off too, sleeping the whole delay
+        def update_index():
+            raise Exception('Connection refused')
+        indexer.update_index = update_index
+        sleeps = []
+        sleep, time.sleep = time.sleep, sleeps.append
+        try:
+            self.assertEqual(indexer.step(2), 4)
+        finally:
+            time.sleep = sleep
+        self.assertEqual(sleeps, [2])
+
+        # A slow batch halves the batch size
+        indexer.adapt_batch_size(40, 20)
+        self.assertEqual(indexer.batch_size, 20)
+        indexer.adapt_batch_size(20, 11)
+        indexer.adapt_batch_size(10, 11)
+        self.assertEqual(indexer.batch_size, 10)
+
     def test_0900_batch_indexing(self):
         with Transaction().start(DB_NAME, USER, context=CONTEXT):
             self.Configuration(1).save()
@@ -172,6 +535,535 @@ class DocumentTypeTestCase(unittest.TestCase):
             backlog_new_len = self.IndexBacklog.search([], count=True)
             self.assertEqual(backlog_old_len + 2, backlog_new_len)
 
+    def test_indexed_models(self):
+        '''
+        The set of indexed models follows the document types
+        '''
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.assertEqual(self.DocumentType.get_indexed_models(), set())
+            defaults = self.create_defaults()
+            self.assertEqual(
+                self.DocumentType.get_indexed_models(), set(['res.user'])
+            )
+
+            self.DocumentType.delete(defaults.values())
+            self.assertEqual(self.DocumentType.get_indexed_models(), set())
+
+    def test_source_fields(self):
+        '''
+        Only changes to the fields used by the documents are indexed
+        '''
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            defaults = self.create_defaults()
+            dt1 = defaults['document_type1']
+            dt2 = defaults['document_type2']
+
+            # Without mapping any field may be used
+            self.assertIsNone(dt1.get_source_fields())
+            self.assertTrue(
+                self.DocumentType.is_indexed_change('res.user', ['password'])
+            )
+            self.assertFalse(
+                self.DocumentType.is_indexed_change('res.group', ['name'])
+            )
+
+            self.DocumentType.write([dt1], {
+                'mapping': '{"properties": {"name": {"type": "string"}}}',
+            })
+            self.DocumentType.write([dt2], {'source_fields': 'login, email'})
+            self.assertEqual(
+                self.DocumentType(dt1.id).get_source_fields(), set(['name'])
+            )
+            self.assertTrue(
+                self.DocumentType.is_indexed_change('res.user', ['email'])
+            )
+            self.assertFalse(
+                self.DocumentType.is_indexed_change('res.user', ['password'])
+            )
+
+            # The value of a function field may come from any field
+            self.DocumentType.write([dt1], {
+                'mapping': '{"res_user": {"properties": {"rec_name": {}}}}',
+            })
+            self.assertTrue(
+                self.DocumentType.is_indexed_change('res.user', ['password'])
+            )
+
+            self.assertRaises(
+                UserError, self.DocumentType.write,
+                [dt2], {'source_fields': 'foo'}
+            )
+
+    def test_dependencies(self):
+        '''
+        Records pointing to the records of a related model are added to the
+        backlog when the related records are
+        '''
+        Dependency = POOL.get('elasticsearch.document.type.dependency')
+        Lang = POOL.get('ir.lang')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            defaults = self.create_defaults()
+            lang_model, = self.Model.search([('model', '=', 'ir.lang')])
+            lang, = Lang.search([('code', '=', 'en_US')])
+
+            self.assertRaises(UserError, Dependency.create, [{
+                'document_type': defaults['document_type1'].id,
+                'model': lang_model.id,
+                'path': 'login',
+            }])
+            Dependency.create([{
+                'document_type': defaults['document_type1'].id,
+                'model': lang_model.id,
+                'path': 'language',
+            }])
+            self.assertEqual(Dependency.get_related_models(), ['ir.lang'])
+
+            users = self.create_users()
+            self.User.write(users, {'language': lang.id})
+            self.IndexBacklog.delete(self.IndexBacklog.search([]))
+
+            self.IndexBacklog.create_from_records([lang])
+            batch = self.IndexBacklog._get_batch(10)
+            self.assertEqual(self.IndexBacklog._expand_dependencies(batch), [])
+            self.assertEqual(
+                sorted(
+                    b.record_id for b in self.IndexBacklog.search([
+                        ('record_model', '=', 'res.user'),
+                    ])
+                ),
+                sorted(map(int, self.User.search([
+                    ('language', '=', lang.id),
+                ])))
+            )
+
+            # Records already in the backlog are not added twice
+            self.IndexBacklog._expand_dependencies(batch)
+            self.assertEqual(
+                self.IndexBacklog.search([
+                    ('record_model', '=', 'res.user'),
+                ], count=True), self.User.search([
+                    ('language', '=', lang.id),
+                ], count=True)
+            )
+
+    def test_languages(self):
+        '''
+        The documents are built in each language of the document types
+        '''
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            defaults = self.create_defaults()
+            user1, user2 = self.create_users()
+
+            self.assertRaises(
+                UserError, self.DocumentType.write,
+                [defaults['document_type1']], {'languages': 'xx_XX'}
+            )
+            self.DocumentType.write(
+                [defaults['document_type1']], {'languages': 'fr_FR'}
+            )
+            self.assertEqual(
+                self.DocumentType.get_languages('res.user'), ['fr_FR']
+            )
+
+            sources = self.IndexBacklog._get_sources('res.user', [user1.id])
+            self.assertEqual(
+                sources[user1.id],
+                '{"fr_FR":{"rec_name":"testuser"},"rec_name":"testuser"}'
+            )
+
+    def test_reindex_all_records(self):
+        '''
+        Reindexing all records does not queue records twice
+        '''
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            defaults = self.create_defaults()
+            self.create_users()
+            self.assertEqual(len(self.IndexBacklog.search([])), 2)
+
+            self.DocumentType.reindex_all_records(
+                [defaults['document_type1']]
+            )
+            self.assertEqual(
+                len(self.IndexBacklog.search([])),
+                self.User.search([], count=True)
+            )
+            self.assertIsNone(defaults['document_type1'].reindex_last_id)
+
+            self.DocumentType.reindex_all_records(
+                [defaults['document_type1']]
+            )
+            self.assertEqual(
+                len(self.IndexBacklog.search([])),
+                self.User.search([], count=True)
+            )
+
+    def test_reindex_checkpoint(self):
+        '''
+        Reindexing chunk by chunk resumes from the checkpoint
+        '''
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            defaults = self.create_defaults()
+            self.create_users()
+            self.IndexBacklog.delete(self.IndexBacklog.search([]))
+            users = self.User.search([], order=[('id', 'ASC')])
+
+            dt1 = defaults['document_type1']
+            self.assertEqual(dt1.reindex_next_chunk(1), 1)
+            self.assertEqual(
+                self.DocumentType(dt1.id).reindex_last_id, users[0].id
+            )
+            self.assertEqual(
+                [b.record_id for b in self.IndexBacklog.search([])],
+                [users[0].id]
+            )
+
+            self.assertEqual(
+                self.DocumentType(dt1.id).reindex_next_chunk(1000),
+                len(users) - 1
+            )
+            self.assertEqual(
+                len(self.IndexBacklog.search([])), len(users)
+            )
+            self.assertEqual(
+                self.DocumentType(dt1.id).reindex_next_chunk(1000), 0
+            )
+            self.assertIsNone(self.DocumentType(dt1.id).reindex_last_id)
+
+    def test_batch_sharing(self):
+        '''
+        The backlog is handled oldest first and shared between models
+        '''
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            defaults = self.create_defaults()
+            users = self.User.create([{
+                'name': 'user%s' % index,
+                'login': 'user%s' % index,
+            } for index in xrange(1, 21)])
+            self.assertEqual(len(self.IndexBacklog.search([])), 20)
+            self.IndexBacklog.create_from_records([defaults['document_type1']])
+
+            items = self.IndexBacklog._get_batch(10)
+            self.assertEqual(len(items), 10)
+            self.assertEqual(
+                [i['record_id'] for i in items[:9]],
+                [user.id for user in users[:9]]
+            )
+            self.assertEqual(
+                items[-1]['record_model'], 'elasticsearch.document.type'
+            )
+
+            self.assertTrue(self.IndexBacklog.get_max_latency() >= 0)
+
+    def test_failed_model(self):
+        '''
+        The entries of a model which could not be indexed stay in the
+        backlog while the other models of the batch are indexed
+        '''
+        Group = POOL.get('res.group')
+
+        def failing_send(failed_type):
+            def send(bulk, actions):
+                succeeded, failed = [], []
+                for key, command in actions:
+                    header, = json.loads(command.split('\n')[0]).values()
+                    if header['_type'] == failed_type:
+                        failed.append((key, 'Some Error'))
+                    else:
+                        succeeded.append(key)
+                bulk._record(succeeded, failed)
+            return send
+
+        # Whatever the order of the models in the batch
+        for failed_model in ('res.user', 'res.group'):
+            with Transaction().start(DB_NAME, USER, context=CONTEXT):
+                self.create_defaults()
+                group_model, = self.Model.search([
+                    ('model', '=', 'res.group'),
+                ])
+                self.DocumentType.create([{
+                    'name': 'TestGroup',
+                    'model': group_model.id,
+                }])
+                users = self.create_users()
+                groups = Group.create([{'name': 'testgroup'}])
+                records = {'res.user': users, 'res.group': groups}
+
+                send = BulkRequest.send
+                BulkRequest.send = failing_send(
+                    self.Configuration.make_type_name(failed_model)
+                )
+                try:
+                    self.IndexBacklog.update_index()
+                finally:
+                    BulkRequest.send = send
+
+                backlogs = self.IndexBacklog.search([])
+                self.assertEqual(
+                    sorted((b.record_model, b.record_id) for b in backlogs),
+                    sorted(
+                        (failed_model, r.id) for r in records[failed_model]
+                    )
+                )
+                self.assertEqual(set(b.attempts for b in backlogs), set([1]))
+
+    def test_failed_document(self):
+        '''
+        A record whose document can not be built stays in the backlog with
+        the error while the other records of the batch are indexed
+        '''
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.create_defaults()
+            user1, user2 = self.create_users()
+
+            get_document = self.IndexBacklog._get_document
+
+            def failing_get_document(record):
+                if record.id == user1.id:
+                    raise ValueError('Some Error')
+                return get_document(record)
+
+            self.IndexBacklog._get_document = staticmethod(
+                failing_get_document
+            )
+            try:
+                self.assertEqual(self.IndexBacklog.update_index(), 1)
+            finally:
+                self.IndexBacklog._get_document = classmethod(
+                    get_document.im_func
+                )
+
+            backlog, = self.IndexBacklog.search([])
+            self.assertEqual(backlog.record_id, user1.id)
+            self.assertEqual(backlog.attempts, 1)
+            self.assertIn('ValueError: Some Error', backlog.last_error)
+            self.assertTrue(backlog.next_attempt > datetime.now())
+
+    def test_unchanged_documents(self):
+        '''
+        Documents which did not change are not sent again
+        '''
+        IndexFingerprint = POOL.get('elasticsearch.index_fingerprint')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.create_defaults()
+            user1, user2 = self.create_users()
+            self.IndexBacklog.update_index()
+            self.assertEqual(len(self.IndexBacklog.search([])), 0)
+            fingerprints = IndexFingerprint.get_fingerprints(
+                'res.user', [user1.id, user2.id]
+            )
+            self.assertEqual(len(fingerprints), 2)
+
+            self.User.write([user1], {'name': 'testuser changed'})
+            self.IndexBacklog.create_from_records([user1, user2])
+            self.IndexBacklog.update_index()
+            self.assertEqual(len(self.IndexBacklog.search([])), 0)
+            new_fingerprints = IndexFingerprint.get_fingerprints(
+                'res.user', [user1.id, user2.id]
+            )
+            self.assertNotEqual(
+                new_fingerprints[user1.id], fingerprints[user1.id]
+            )
+            self.assertEqual(
+                new_fingerprints[user2.id], fingerprints[user2.id]
+            )
+            # The fingerprint of a record is replaced
+            self.assertEqual(len(IndexFingerprint.search([
+                ('record_model', '=', 'res.user'),
+                ('record_id', '=', user1.id),
+            ])), 1)
+
+            # Reindexing forgets the fingerprints
+            self.DocumentType.reindex_all_records(
+                self.DocumentType.search([])
+            )
+            self.assertEqual(
+                IndexFingerprint.get_fingerprints(
+                    'res.user', [user1.id, user2.id]
+                ), {}
+            )
+
+            # Deleted records have no fingerprint
+            self.IndexBacklog.update_index(1000)
+            self.User.delete([user1])
+            self.IndexBacklog.update_index()
+            self.assertEqual(
+                IndexFingerprint.get_fingerprints(
+                    'res.user', [user1.id, user2.id]
+                ).keys(), [user2.id]
+            )
+
+    def test_metrics(self):
+        '''
+        The batches save the documents handled and the time of each stage
+        '''
+        IndexBatch = POOL.get('elasticsearch.index_batch')
+        IndexStatistics = POOL.get('elasticsearch.index_statistics')
+        IndexBacklogStatus = POOL.get('elasticsearch.index_backlog.status')
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.create_defaults()
+            user1, user2 = self.create_users()
+
+            status, = IndexBacklogStatus.search([])
+            self.assertEqual(status.record_model, 'res.user')
+            self.assertEqual(status.entries, 2)
+            self.assertEqual(status.failing, 0)
+            self.assertTrue(status.age >= 0)
+            self.assertEqual(
+                status.oldest_date, self.IndexBacklog(status.id).create_date
+            )
+
+            # The state of the backlog is sent to statsd on its own
+            server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            server.bind(('127.0.0.1', 0))
+            server.settimeout(5)
+            config.set('elastic_search', 'statsd_host', '127.0.0.1')
+            config.set(
+                'elastic_search', 'statsd_port', str(server.getsockname()[1])
+            )
+            try:
+                IndexBacklogStatus.send_statsd_metrics()
+                packet = server.recv(4096)
+            finally:
+                config.remove_option('elastic_search', 'statsd_host')
+                config.remove_option('elastic_search', 'statsd_port')
+                server.close()
+            self.assertIn(
+                'trytond.elasticsearch.res_user.backlog.entries:2|g',
+                packet.split('\n')
+            )
+
+            self.IndexBacklog.update_index()
+            self.assertEqual(IndexBacklogStatus.search([]), [])
+            batch, = IndexBatch.search([])
+            self.assertEqual(batch.entries, 2)
+            self.assertTrue(batch.duration >= batch.serialize_time)
+            line, = batch.models
+            self.assertEqual(line.record_model, 'res.user')
+            self.assertEqual((line.indexed, line.skipped), (2, 0))
+            self.assertIn(line.slowest_json_record, [user1.id, user2.id])
+
+            self.IndexBacklog.create_from_records([user1])
+            self.IndexBacklog.update_index()
+            self.User.delete([user2])
+            self.IndexBacklog.update_index()
+            statistic, = IndexStatistics.search([])
+            self.assertEqual(statistic.batches, 3)
+            self.assertEqual(
+                (statistic.indexed, statistic.skipped, statistic.deleted),
+                (2, 1, 1)
+            )
+
+            text = prometheus_text()
+            self.assertIn('trytond_elasticsearch_batches 3\n', text)
+            self.assertIn(
+                'trytond_elasticsearch_documents{model="res.user",'
+                'result="skipped"} 1\n', text
+            )
+
+    def test_bulk_export(self):
+        '''
+        Export the records straight to the index
+        '''
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            defaults = self.create_defaults()
+            self.create_users()
+            config = self.Configuration(1)
+            conn = self.Configuration.get_es_connection()
+            self.Configuration.update_settings([config])
+
+            self.DocumentType.bulk_export([defaults['document_type1']])
+            self.assertEqual(len(self.IndexBacklog.search([])), 2)
+
+            time.sleep(2)  # wait for changes to reach search server
+            result = conn.search(query=TermQuery('rec_name', 'testuser2'))
+            self.assertEqual(len(result), 1)
+
+            settings, = conn.indices.get_settings(
+                config.index_name
+            ).values()
+            self.assertEqual(
+                settings['settings']['index']['refresh_interval'], '1s'
+            )
+
+    def test_bulk_export_deleted(self):
+        '''
+        The records deleted while they are exported are not left in the
+        index
+        '''
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            defaults = self.create_defaults()
+            user, _ = self.create_users()
+            config = self.Configuration(1)
+            conn = self.Configuration.get_es_connection()
+            self.Configuration.update_settings([config])
+
+            cursor = Transaction().cursor
+            user_table = self.User.__table__()
+            get_sources = self.IndexBacklog._get_sources
+
+            def get_sources_and_delete(
+                    model_name, ids, timings=None, errors=None):
+                # The record is deleted once its document is built, as if
+                # by another transaction
+                sources = get_sources(model_name, ids, timings, errors)
+                cursor.execute(*user_table.delete(
+                    where=user_table.id == user.id
+                ))
+                return sources
+
+            self.IndexBacklog._get_sources = staticmethod(
+                get_sources_and_delete
+            )
+            try:
+                self.DocumentType.bulk_export([defaults['document_type1']])
+            finally:
+                self.IndexBacklog._get_sources = classmethod(
+                    get_sources.im_func
+                )
+
+            time.sleep(2)  # wait for changes to reach search server
+            result = conn.search(query=TermQuery('rec_name', 'testuser'))
+            self.assertEqual(len(result), 0)
+            result = conn.search(query=TermQuery('rec_name', 'testuser2'))
+            self.assertEqual(len(result), 1)
+
+    def test_rebuild_index(self):
+        '''
+        Rebuild the index in a new version and switch the alias to it
+        '''
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            self.create_defaults()
+            self.create_users()
+            config = self.Configuration(1)
+            conn = self.Configuration.get_es_connection()
+            self.Configuration.update_settings([config])
+
+            self.Configuration.rebuild_index([config])
+            self.assertEqual(len(self.IndexBacklog.search([])), 2)
+            self.assertIsNone(self.Configuration.get_building_index(conn))
+
+            time.sleep(2)  # wait for changes to reach search server
+            result = conn.search(query=TermQuery('rec_name', 'testuser'))
+            self.assertEqual(len(result), 1)
+
+            def get_indices():
+                aliases = conn.indices.aliases('_all')
+                return [
+                    i for i, v in aliases.iteritems()
+                    if config.index_name in v['aliases']
+                ]
+            # The versions created by the previous runs are skipped
+            index_name, = get_indices()
+            self.Configuration.rebuild_index([config])
+            self.assertEqual(get_indices(), [
+                self.Configuration.get_next_index_version_name(
+                    config.index_name, [index_name]
+                )
+            ])
+
     def test_delete(self):
         '''
         Test if records are deleted from remove elastic server
@@ -196,6 +1088,118 @@ class DocumentTypeTestCase(unittest.TestCase):
             self.assertEqual(len(result), 0)
 
 
+class BulkRequestTestCase(unittest.TestCase):
+    """
+    Test the bulk requests against a fake elastic search server
+    """
+
+    def setUp(self):
+        self.fake = FakeElasticSearch().start()
+        self.conn = ES(self.fake.uri)
+
+    def tearDown(self):
+        self.fake.stop()
+
+    def make_bulk(self, count, **kwargs):
+        "Return a bulk request with the given number of documents added"
+        kwargs.setdefault('retry_delay', 0)
+        bulk = BulkRequest(self.conn, **kwargs)
+        for id in range(1, count + 1):
+            bulk.index(id, 'test', 'doc', id, {'name': 'doc%d' % id})
+        return bulk
+
+    def test_request_retry(self):
+        """
+        Requests rejected because elastic search is overloaded are retried
+        """
+        self.fake.error_status, self.fake.pending_errors = 429, 2
+        bulk = self.make_bulk(2, max_retries=2)
+        bulk.flush()
+
+        self.assertEqual(sorted(bulk.succeeded), [1, 2])
+        self.assertEqual(bulk.failed, {})
+        self.assertEqual(self.fake.requests['_bulk'], 3)
+        self.assertEqual(len(self.fake.documents), 2)
+
+    def test_item_retry(self):
+        """
+        Only the items rejected because elastic search is overloaded are
+        retried
+        """
+        self.fake.pending_item_errors = 1
+        bulk = self.make_bulk(3)
+        bulk.flush()
+
+        self.assertEqual(sorted(bulk.succeeded), [1, 2, 3])
+        self.assertEqual(bulk.failed, {})
+        self.assertEqual(self.fake.requests['_bulk'], 2)
+        self.assertEqual(len(self.fake.documents), 3)
+
+    def test_retries_exhausted(self):
+        """
+        The actions still rejected after the last retry are failed, as are
+        the requests which failed for another reason
+        """
+        self.fake.error_status, self.fake.pending_errors = 429, 3
+        bulk = self.make_bulk(2, max_retries=2)
+        bulk.flush()
+        self.assertEqual(bulk.succeeded, [])
+        self.assertEqual(sorted(bulk.failed), [1, 2])
+        self.assertEqual(self.fake.requests['_bulk'], 3)
+
+        self.fake.reset()
+        self.fake.pending_item_errors = 6
+        bulk = self.make_bulk(2, max_retries=2)
+        bulk.flush()
+        self.assertEqual(bulk.succeeded, [])
+        self.assertEqual(
+            bulk.failed, {1: 'Injected error', 2: 'Injected error'}
+        )
+        self.assertEqual(self.fake.requests['_bulk'], 3)
+
+        self.fake.reset()
+        self.fake.error_status, self.fake.pending_errors = 503, 1
+        bulk = self.make_bulk(2, max_retries=2)
+        bulk.flush()
+        self.assertEqual(sorted(bulk.failed), [1, 2])
+        self.assertEqual(self.fake.requests['_bulk'], 1)
+
+    def test_in_flight(self):
+        """
+        With requests sent by several threads, the result of every action
+        is recorded once
+        """
+        self.fake.item_error_rate = 0.3
+        self.fake.error_status, self.fake.pending_errors = 429, 2
+        bulk = self.make_bulk(
+            200, max_docs=10, max_in_flight=2, max_retries=1
+        )
+        bulk.flush()
+
+        self.assertEqual(
+            len(bulk.succeeded) + len(bulk.failed), 200
+        )
+        self.assertEqual(
+            set(bulk.succeeded).union(bulk.failed), set(range(1, 201))
+        )
+        self.assertTrue(bulk.send_time > 0)
+
+    def test_close(self):
+        """
+        The threads are stopped when leaving the context, even on error
+        """
+        with self.assertRaises(ValueError):
+            with self.make_bulk(0, max_docs=10, max_in_flight=2) as bulk:
+                for id in range(1, 101):
+                    bulk.index(id, 'test', 'doc', id, {'name': 'doc'})
+                workers = list(bulk._workers)
+                self.assertEqual(len(workers), 2)
+                raise ValueError
+        self.assertFalse(any(w.is_alive() for w in workers))
+        self.assertEqual(bulk._workers, [])
+        self.assertEqual(bulk._actions, [])
+
+
 def suite():
     suite = trytond.tests.test_tryton.suite()
     suite.addTests(
@@ -204,6 +1208,9 @@ def suite():
     suite.addTests(
         unittest.TestLoader().loadTestsFromTestCase(DocumentTypeTestCase)
     )
+    suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(BulkRequestTestCase)
+    )
     return suite
 
 if __name__ == '__main__':